@@ -1,5 +1,10 @@
+import argparse
+import csv
 import datetime
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 LAB_DIR = os.path.join("/home", "data", "NDClab")
 DATASET_DIR = os.path.join(LAB_DIR, "datasets")
@@ -9,85 +14,320 @@ DATE_STR = datetime.datetime.now().strftime("%m-%d-%Y")
 BACKUP_LIST = {"sourcedata", "derivatives"}
 SKIPPED_DATASETS = {"bug-testing-dataset"}
 
+MANIFEST_FILE = "backup_manifest.csv"  # in each dataset's backup folder
+MANIFEST_COLUMNS = ["path", "inode", "size", "mtime_ns", "link", "deleted"]
+
+DEFAULT_WORKERS = 4  # dataset subtrees backed up at once
+DEFAULT_OPS_PER_SECOND = 500  # directory listings, stats, mkdirs and links per second, across all workers
+
+
+class RateLimiter:
+    """
+    Spaces out metadata operations so that all workers together make at most
+    `rate` of them per second (a rate of 0 means no limit).
+    """
+
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_time)
+            self.next_time = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Hard-link backup of every dataset")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=DEFAULT_WORKERS,
+        help=f"dataset subtrees to back up at once (default {DEFAULT_WORKERS})",
+    )
+    parser.add_argument(
+        "--ops-per-second",
+        type=float,
+        default=DEFAULT_OPS_PER_SECOND,
+        help="limit on directory listings, stats, mkdirs and links per second across all "
+        f"workers, 0 for no limit (default {DEFAULT_OPS_PER_SECOND})",
+    )
+    return parser.parse_args()
+
 
 def main():
+    args = parse_args()
+    limiter = RateLimiter(args.ops_per_second)
     print("Beginning backup...")
     print(f"Start time {datetime.datetime.now().isoformat()}")
-    for dataset in os.listdir(DATASET_DIR):
+    print(f"{args.workers} worker(s), at most {args.ops_per_second:g} metadata ops/s")
+
+    # one task per (dataset, subtree), so large datasets are split across workers
+    tasks = []
+    for dataset in sorted(os.listdir(DATASET_DIR)):
         if dataset in SKIPPED_DATASETS:
             print(f"Skipping {dataset}")
             continue
-        print(f"Backing up {dataset}")
-        backup_dataset(dataset)
+        for backup_subdir in sorted(BACKUP_LIST):
+            if os.path.isdir(os.path.join(DATASET_DIR, dataset, backup_subdir)):
+                tasks.append((dataset, backup_subdir))
+
+    remaining = {}  # dataset -> subtrees not finished yet
+    for dataset, _ in tasks:
+        remaining[dataset] = remaining.get(dataset, 0) + 1
+    summaries = {dataset: new_summary() for dataset in remaining}
+    manifests = {dataset: read_manifest(dataset) for dataset in remaining}
+
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            executor.submit(
+                backup_subtree, dataset, backup_subdir, limiter, *manifest_for(manifests[dataset], backup_subdir)
+            ): dataset
+            for dataset, backup_subdir in tasks
+        }
+        for future in as_completed(futures):
+            dataset = futures[future]
+            try:
+                add_summary(summaries[dataset], future.result())
+            except Exception as err:
+                print(f"Error backing up {dataset}: {err}")
+                summaries[dataset]["failed"] += 1
+            remaining[dataset] -= 1
+            if remaining[dataset] == 0:
+                write_manifest(dataset, manifests[dataset][0])
+                print_summary(dataset, summaries[dataset])
 
     print("Finished backup!")
     print(f"End time {datetime.datetime.now().isoformat()}")
 
 
-def backup_dataset(dataset: str):
-    dataset_backup = os.path.join(BACKUP_DIR, dataset)
-    # ensure that our backup directory exists
-    if not os.path.isdir(dataset_backup):
-        os.makedirs(dataset_backup, exist_ok=True)
-
-    for backup_subdir in BACKUP_LIST:
-        source_dir = os.path.join(DATASET_DIR, dataset, backup_subdir)
-        target_dir = os.path.join(dataset_backup, backup_subdir)
-
-        if not os.path.isdir(source_dir):
-            continue  # can't back up something that isn't there!
-
-        # collect all files under the source dir
-        # NB: we do this *once* to minimize costly file system API calls
-        source_tree = {}
-        for root, _, files in os.walk(source_dir):
-            rel_path = os.path.relpath(root, source_dir)
-            source_tree[rel_path] = files
-
-        # mirror the dataset's directory structure to our backup path
-        for rel_path in source_tree:
-            backup_subdir_path = os.path.join(target_dir, rel_path)
-            if not os.path.isdir(backup_subdir_path):
-                os.makedirs(backup_subdir_path, exist_ok=True)
-
-        for rel_path, files in source_tree.items():
-            # current folder in the backup
-            backup_subdir_path = os.path.join(target_dir, rel_path)
+def read_manifest(dataset: str):
+    """
+    Read a dataset's backup manifest: the file each backup link was made from.
+
+    Returns (rows, found): rows is {subtree: {path: row}}, with paths relative
+    to the dataset (e.g. "sourcedata/raw/s1_r1/eeg/sub-1.eeg") and rows of
+    MANIFEST_COLUMNS; found is False when the dataset has no manifest yet.
+    """
+    manifest_file = os.path.join(BACKUP_DIR, dataset, MANIFEST_FILE)
+    rows = {}
+    if not os.path.isfile(manifest_file):
+        return rows, False
+    with open(manifest_file, "r", newline="") as f:
+        for row in csv.DictReader(f):
+            subtree = row["path"].split(os.sep, 1)[0]
+            rows.setdefault(subtree, {})[row["path"]] = row
+    return rows, True
+
+
+def manifest_for(manifest: tuple, backup_subdir: str):
+    """The (rows, found) of one subtree, from read_manifest's output."""
+    rows, found = manifest
+    return rows.setdefault(backup_subdir, {}), found
+
+
+def write_manifest(dataset: str, rows: dict):
+    manifest_file = os.path.join(BACKUP_DIR, dataset, MANIFEST_FILE)
+    os.makedirs(os.path.dirname(manifest_file), exist_ok=True)
+    with open(manifest_file + ".tmp", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=MANIFEST_COLUMNS)
+        writer.writeheader()
+        for subtree in sorted(rows):
+            for path in sorted(rows[subtree]):
+                writer.writerow(rows[subtree][path])
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+
+def new_summary():
+    return {"linked": 0, "skipped": 0, "deleted": 0, "failed": 0, "start": None, "end": None}
+
+
+def add_summary(summary: dict, subtree_summary: dict):
+    for key in ["linked", "skipped", "deleted", "failed"]:
+        summary[key] += subtree_summary[key]
+    if summary["start"] is None or subtree_summary["start"] < summary["start"]:
+        summary["start"] = subtree_summary["start"]
+    if summary["end"] is None or subtree_summary["end"] > summary["end"]:
+        summary["end"] = subtree_summary["end"]
 
+
+def print_summary(dataset: str, summary: dict):
+    elapsed = summary["end"] - summary["start"] if summary["start"] is not None else 0
+    print(
+        f"Backed up {dataset} in {elapsed:.1f}s: {summary['linked']} linked, "
+        f"{summary['skipped']} skipped, {summary['deleted']} deleted, {summary['failed']} failed"
+    )
+
+
+def backup_dataset(dataset: str, limiter: RateLimiter = None):
+    """Back up every subtree of one dataset, one after another."""
+    summary = new_summary()
+    manifest = read_manifest(dataset)
+    for backup_subdir in sorted(BACKUP_LIST):
+        add_summary(summary, backup_subtree(dataset, backup_subdir, limiter, *manifest_for(manifest, backup_subdir)))
+    write_manifest(dataset, manifest[0])
+    return summary
+
+
+def find_legacy_link(backup_subdir_path: str, filename: str, inode: int, listings: dict):
+    """
+    Find a link to inode among "<filename>-link-<date>" in a backup folder
+    made before the manifest existed, listing each folder at most once.
+    """
+    if backup_subdir_path not in listings:
+        try:
+            listings[backup_subdir_path] = os.listdir(backup_subdir_path)
+        except FileNotFoundError:
+            listings[backup_subdir_path] = []
+    for item in listings[backup_subdir_path]:
+        # everything up to "-link-" is the original file's basename
+        if "-link-" in item and item.split("-link-")[0] == filename:
             try:
-                existing_backup_items = os.listdir(backup_subdir_path)
+                if os.stat(os.path.join(backup_subdir_path, item)).st_ino == inode:
+                    return item
             except FileNotFoundError:
-                # if the folder somehow doesn't exist, create it and move on
-                os.makedirs(backup_subdir_path, exist_ok=True)
-                existing_backup_items = []
-
-            # build a quick set of 'basenames' that already have a hard link
-            # e.g. if "mydata-link-01-01-2025" exists, store "mydata" as linked
-            already_linked_basenames = set()
-            for item in existing_backup_items:
-                if "-link-" in item:
-                    # everything up to "-link-" is the original file's basename
-                    base_before_link = item.split("-link-")[0]
-                    already_linked_basenames.add(base_before_link)
-
-            # for each file in this source directory, create a link if needed
-            for filename in files:
-                if filename in already_linked_basenames:
-                    continue  # hard link already exists
-
-                src_file = os.path.join(source_dir, rel_path, filename)
+                pass
+    return None
+
+
+def backup_subtree(
+    dataset: str,
+    backup_subdir: str,
+    limiter: RateLimiter = None,
+    manifest: dict = None,
+    manifest_found: bool = False,
+):
+    """
+    Hard-link every file of one dataset subtree (e.g. sourcedata) that the
+    backup doesn't have yet.
+
+    Files are matched to the manifest rows of the subtree (see read_manifest),
+    updated in place: a file whose inode is unchanged is skipped without
+    looking at the backup folder (if it was modified in place, its link
+    already shares the new content, so only its size and mtime are updated),
+    while a new file, or one replaced by a new inode, gets a new dated link.
+    Files gone from the source are marked deleted. Without a manifest yet,
+    existing links are found by listing the backup folders once.
+
+    Returns a summary dict: files "linked", "skipped" (already linked),
+    "deleted" and "failed", and the "start" and "end" times.
+    """
+    if limiter is None:
+        limiter = RateLimiter(0)
+    if manifest is None:
+        manifest = {}
+    summary = new_summary()
+    summary["start"] = time.monotonic()
+
+    dataset_backup = os.path.join(BACKUP_DIR, dataset)
+    source_dir = os.path.join(DATASET_DIR, dataset, backup_subdir)
+    target_dir = os.path.join(dataset_backup, backup_subdir)
+
+    if not os.path.isdir(source_dir):
+        summary["end"] = time.monotonic()
+        return summary  # can't back up something that isn't there!
+
+    # collect all files under the source dir
+    # NB: we do this *once* to minimize costly file system API calls
+    source_tree = {}
+    for root, _, files in os.walk(source_dir):
+        limiter.wait()  # the listing of root
+        rel_path = os.path.relpath(root, source_dir)
+        source_tree[rel_path] = files
+
+    # mirror the dataset's directory structure to our backup path
+    for rel_path in source_tree:
+        backup_subdir_path = os.path.join(target_dir, rel_path)
+        if not os.path.isdir(backup_subdir_path):
+            limiter.wait()
+            os.makedirs(backup_subdir_path, exist_ok=True)
+
+    seen = set()
+    legacy_listings = {}  # backup folder -> its items, only used without a manifest
+    for rel_path, files in source_tree.items():
+        # current folder in the backup
+        backup_subdir_path = os.path.join(target_dir, rel_path)
+
+        for filename in files:
+            src_file = os.path.join(source_dir, rel_path, filename)
+            path = os.path.normpath(os.path.join(backup_subdir, rel_path, filename))
+            seen.add(path)
+            limiter.wait()
+            try:
+                st = os.stat(src_file)
+            except OSError as err:
+                print(f"Could not read {src_file}. Error: {err}")
+                summary["failed"] += 1
+                continue
+            row = manifest.get(path)
+            if row is not None and not row["deleted"] and int(row["inode"]) == st.st_ino:
+                # same file as last time (if it was modified in place, the link already shares it)
+                row["size"], row["mtime_ns"] = st.st_size, st.st_mtime_ns
+                summary["skipped"] += 1
+                continue
+
+            link_name = None
+            if not manifest_found:
+                if backup_subdir_path not in legacy_listings:
+                    limiter.wait()
+                link_name = find_legacy_link(backup_subdir_path, filename, st.st_ino, legacy_listings)
+            if link_name is not None:
+                summary["skipped"] += 1  # hard link already exists
+            else:
+                same_day = 1
                 link_name = f"{filename}-link-{DATE_STR}"
                 backup_file_path = os.path.join(backup_subdir_path, link_name)
-
-                print(f"Creating link {backup_file_path}")
+                replaced = row is not None and not row["deleted"]
 
                 try:  # hard link creation
-                    os.link(src_file, backup_file_path)
-                except FileExistsError:
-                    pass  # if link already exists, do nothing
+                    while True:
+                        limiter.wait()
+                        try:
+                            os.link(src_file, backup_file_path)
+                            if replaced:
+                                print(f"Replaced since {row['link']}, created link {backup_file_path}")
+                            else:
+                                print(f"Created link {backup_file_path}")
+                            summary["linked"] += 1
+                            break
+                        except FileExistsError:
+                            # linked earlier today: fine if it's this same file, else
+                            # it was replaced since, so try "<name>-link-<date>-2" etc.
+                            limiter.wait()
+                            if os.stat(backup_file_path).st_ino == st.st_ino:
+                                summary["skipped"] += 1
+                                break
+                            same_day += 1
+                            link_name = f"{filename}-link-{DATE_STR}-{same_day}"
+                            backup_file_path = os.path.join(backup_subdir_path, link_name)
                 except OSError as err:
                     # could be permission issues, etc.
                     print(f"Could not create link for {src_file}. Error: {err}")
+                    summary["failed"] += 1
+                    continue
+            manifest[path] = {
+                "path": path,
+                "inode": st.st_ino,
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+                "link": link_name,
+                "deleted": "",
+            }
+
+    # record files that are no longer in the source (their links are kept)
+    for path, row in manifest.items():
+        if path not in seen and not row["deleted"]:
+            row["deleted"] = DATE_STR
+            summary["deleted"] += 1
+
+    summary["end"] = time.monotonic()
+    return summary
 
 
 if __name__ == "__main__":
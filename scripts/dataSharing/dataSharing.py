@@ -4,14 +4,36 @@
 # =========================
 import sys
 import argparse
+import bisect
+import io
 import os
 import re
+import shutil
+import sqlite3
+import time
+import zipfile
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
+from functools import lru_cache
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "redcap_cache"))
+try:
+    from redcap_cache import read_redcap
+except ImportError:  # lab-devOps checkout without the cache, parse directly
+    read_redcap = pd.read_csv
+try:
+    from openpyxl import Workbook
+except ImportError:  # pandas picks another Excel engine, without streaming
+    Workbook = None
 
 # Paths and Configurations
 INSTRUMENTS_DATADICT_PATH = '/home/data/NDClab/tools/instruments'
 ALLMEASURES_PATH = 'allMeasures.csv'
+SESSION_SUFFIX_RE = re.compile(r'_s\d+_r\d+_e\d+$')
+TRIE_END = ""  # marks a node where a full instrument name ends
+EXPORT_CHUNK_ROWS = 10000  # rows converted at a time by the streaming writers
+BATCH_THREADS = 4  # SCRD files read / outputs written at once with --batch
 COLOR_MAP = {
     "red": "\033[91m",
     "green": "\033[92m",
@@ -30,11 +52,51 @@ def parse_args():
     parser = argparse.ArgumentParser(description="Data Sharing Protocol")
     parser.add_argument('--name', type=str, help='Name of the dataset')
     parser.add_argument('--input', type=str, help='Input file path')
-    parser.add_argument('--output', type=str, help='Output file path')
+    parser.add_argument('--output', type=str, help='Output file path (.xlsx, .zip of CSVs, .parquet folder, .sqlite/.db)')
     parser.add_argument('--verbose', action='store_true', help='Enable verbose output')
     parser.add_argument('--vars', type=str, help='Variables to process, comma-separated')
+    parser.add_argument('--batch', type=str, help='Folder of input CSVs, or manifest CSV of requests, to run together')
+    parser.add_argument('--threads', type=int, default=BATCH_THREADS, help='Threads for --batch reads and outputs')
     return parser.parse_args()
 
+def read_input_csv(path):
+    """An --input CSV, with redcapProject split into a list of projects."""
+    inputDF = pd.read_csv(path)
+    inputDF['redcapProject'] = inputDF['redcapProject'].apply(lambda x: [item.strip() for item in x.split(',')])
+    return inputDF
+
+def read_batch(batch, output):
+    """
+    The requests of a --batch run, as a list of (input CSV or None, vars or None, output path).
+
+    batch is either a folder, whose *.csv input CSVs are each written to
+    <output folder>/<name>.xlsx, or a manifest CSV with an "output" column and
+    an "input" (input CSV) or "vars" (comma-separated variables) column per
+    request. Relative paths in a manifest are relative to the manifest.
+    """
+    requests = []
+    if os.path.isdir(batch):
+        if not output:
+            raise ValueError("--output must be a folder for a --batch folder")
+        os.makedirs(output, exist_ok=True)
+        for file in sorted(os.listdir(batch)):
+            if file.endswith('.csv'):
+                requests.append((os.path.join(batch, file), None, os.path.join(output, file[:-len('.csv')] + '.xlsx')))
+        return requests
+    manifest = pd.read_csv(batch, dtype=str, keep_default_na=False)
+    if 'output' not in manifest.columns or not ({'input', 'vars'} & set(manifest.columns)):
+        raise ValueError(f"{batch} needs an output column and an input or vars column")
+    base_dir = os.path.dirname(os.path.abspath(batch))
+    for row in manifest.to_dict("records"):
+        input_csv = row.get('input') or None
+        vars = [var.strip() for var in row['vars'].split(',')] if row.get('vars') else None
+        if (input_csv is None) == (vars is None):
+            raise ValueError(f"{batch}: each request needs exactly one of input and vars, see {row['output']}")
+        if input_csv is not None:
+            input_csv = os.path.join(base_dir, input_csv)
+        requests.append((input_csv, vars, os.path.join(base_dir, row['output'])))
+    return requests
+
 def formatted_print(message, color="white"):
     if color != "white":
         color_code = COLOR_MAP.get(color, COLOR_MAP["red"])
@@ -43,16 +105,303 @@ def formatted_print(message, color="white"):
     else:
         print(message)
 
+# =========================
+# Export Backends
+# =========================
+# each writes {sheet name: DataFrame} to a path, yielding (sheet, rows) as each sheet is done
+
+def write_xlsx(df_list, output_file):
+    """Excel workbook, streamed row by row with openpyxl's write-only mode."""
+    if Workbook is None:
+        with pd.ExcelWriter(output_file) as writer:
+            for sheet_name, df in df_list.items():
+                df.to_excel(writer, sheet_name=sheet_name, index=False)
+                yield sheet_name, len(df)
+        return
+    wb = Workbook(write_only=True)
+    for sheet_name, df in df_list.items():
+        ws = wb.create_sheet(title=sheet_name)
+        ws.append([str(col) for col in df.columns])
+        for start in range(0, len(df), EXPORT_CHUNK_ROWS):
+            chunk = df.iloc[start:start + EXPORT_CHUNK_ROWS].astype(object)
+            for row in chunk.where(chunk.notna(), None).itertuples(index=False, name=None):
+                ws.append(row)
+        yield sheet_name, len(df)
+    wb.save(output_file)
+
+def write_csv_zip(df_list, output_file):
+    """Zip with one <sheet>.csv per sheet, each streamed into the archive."""
+    with zipfile.ZipFile(output_file, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for sheet_name, df in df_list.items():
+            info = zipfile.ZipInfo(f"{sheet_name}.csv", date_time=time.localtime()[:6])
+            info.compress_type = zipfile.ZIP_DEFLATED
+            with zf.open(info, "w") as f:
+                with io.TextIOWrapper(f, encoding="utf-8", newline="") as text:
+                    df.to_csv(text, index=False)
+            yield sheet_name, len(df)
+
+def write_parquet(df_list, output_file):
+    """Folder with one <sheet>.parquet per sheet (sheets don't share a schema)."""
+    os.mkdir(output_file)
+    for sheet_name, df in df_list.items():
+        df.to_parquet(os.path.join(output_file, f"{sheet_name}.parquet"), index=False)
+        yield sheet_name, len(df)
+
+def write_sqlite(df_list, output_file):
+    """SQLite database with one table per sheet."""
+    con = sqlite3.connect(output_file)
+    try:
+        for sheet_name, df in df_list.items():
+            df.to_sql(sheet_name, con, index=False, chunksize=EXPORT_CHUNK_ROWS)
+            yield sheet_name, len(df)
+        con.commit()
+    finally:
+        con.close()
+
+EXPORT_BACKENDS = {
+    ".xlsx": write_xlsx,
+    ".zip": write_csv_zip,
+    ".parquet": write_parquet,
+    ".sqlite": write_sqlite,
+    ".db": write_sqlite,
+}
+
+def remove_output(path):
+    """Remove an export, file or folder (parquet), if it exists."""
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def get_export_backend(output_file):
+    """The writer for an --output path, chosen by its extension."""
+    ext = os.path.splitext(output_file)[1].lower()
+    if ext not in EXPORT_BACKENDS:
+        raise ValueError(f"Unsupported --output extension {ext!r}, use one of {', '.join(EXPORT_BACKENDS)}")
+    return EXPORT_BACKENDS[ext]
+
+# =========================
+# Instrument Registry
+# =========================
+class InstrumentRegistry:
+    """allMeasures.csv, parsed once and indexed by instrument name."""
+    def __init__(self, path):
+        measures = pd.read_csv(path, dtype=str, keep_default_na=False)
+        self.entries = dict()  # instrument name -> its allMeasures rows, in file order
+        self.trie = dict()  # one node per character of every instrument name
+        self.reported = set()  # instruments already warned about as ambiguous
+        self.reported_prefixes = set()  # names already warned about as matching several instruments
+        for row in measures.to_dict("records"):
+            name = row['Instrument Name'].strip()
+            if name not in self.entries:
+                self.entries[name] = []
+                node = self.trie
+                for char in name:
+                    node = node.setdefault(char, dict())
+                node[TRIE_END] = name
+            self.entries[name].append(row)
+
+    def get(self, name):
+        """All allMeasures rows for an instrument name ([] if it isn't listed)."""
+        return self.entries.get(name, [])
+
+    def prefixes_of(self, name):
+        """Instrument names that are prefixes of name, shortest first."""
+        matches = []
+        node = self.trie
+        for char in name:
+            node = node.get(char)
+            if node is None:
+                break
+            if TRIE_END in node:
+                matches.append(node[TRIE_END])
+        return matches
+
+@lru_cache(maxsize=None)
+def get_registry(path=ALLMEASURES_PATH):
+    """The registry for path, loaded on first use and shared for the rest of the run."""
+    return InstrumentRegistry(path)
+
+# =========================
+# Data Dictionary Index
+# =========================
+class DatadictIndex:
+    """
+    Every file under the instruments tree, by lower-cased filename.
+
+    The tree is walked once; refresh() then only re-lists directories whose
+    mtime changed. Each datadict's session -> columns map is parsed once and
+    kept until the file's mtime changes.
+    """
+    def __init__(self, root):
+        self.root = os.path.normpath(root)
+        self.dirs = dict()  # dir -> (mtime_ns, subdirs, filenames)
+        self.files = dict()  # lower-cased filename -> paths, sorted
+        self.sessions = dict()  # datadict path -> (mtime_ns, session -> columns)
+
+    def list_dir(self, path):
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+            entries = list(os.scandir(path))
+        except FileNotFoundError:
+            self.dirs.pop(path, None)
+            return
+        subdirs = sorted(entry.path for entry in entries if entry.is_dir() and not entry.is_symlink())
+        filenames = sorted(entry.name for entry in entries if not entry.is_dir())
+        self.dirs[path] = (mtime_ns, subdirs, filenames)
+        for subdir in subdirs:
+            if subdir not in self.dirs:
+                self.list_dir(subdir)
+
+    def refresh(self):
+        if not self.dirs:
+            self.list_dir(self.root)
+        else:
+            changed = False
+            for path, (mtime_ns, _, _) in list(self.dirs.items()):
+                try:
+                    if os.stat(path).st_mtime_ns == mtime_ns:
+                        continue
+                except FileNotFoundError:
+                    pass
+                self.list_dir(path)
+                changed = True
+            if not changed:
+                return
+        # drop directories no longer reachable from the root, then re-key the files
+        reachable = dict()
+        pending = [self.root] if self.root in self.dirs else []
+        while pending:
+            path = pending.pop()
+            reachable[path] = self.dirs[path]
+            pending.extend(subdir for subdir in self.dirs[path][1] if subdir in self.dirs)
+        self.dirs = reachable
+        self.files = dict()
+        for path, (_, _, filenames) in self.dirs.items():
+            for filename in filenames:
+                self.files.setdefault(filename.lower(), []).append(os.path.join(path, filename))
+        for paths in self.files.values():
+            paths.sort()
+
+    def find(self, root_dir, filename):
+        """First file named filename (any case) under root_dir, or None."""
+        root_dir = os.path.normpath(root_dir)
+        if root_dir not in self.dirs:
+            raise FileNotFoundError(f"Root directory does not exist: {root_dir}")
+        for path in self.files.get(filename.lower(), []):
+            if path.startswith(root_dir + os.sep):
+                return path
+        return None
+
+    def get_sessions(self, datadict):
+        """A datadict's columns by session, e.g. {"s1": ["bfne_b_1_s1", ...]}."""
+        mtime_ns = os.stat(datadict).st_mtime_ns
+        cached = self.sessions.get(datadict)
+        if cached is None or cached[0] != mtime_ns:
+            sess = dict()
+            ndx = pd.read_csv(datadict, dtype=str, keep_default_na=False)
+            for variable, allowed in zip(ndx['variable'], ndx['allowedSuffix']):
+                for val in allowed.split(','):
+                    session_num = re.search(r's(\d+)', val).group(1)
+                    suffix = f"s{session_num}"
+                    sess.setdefault(suffix, []).append(f"{variable}_{suffix}")
+            cached = (mtime_ns, sess)
+            self.sessions[datadict] = cached
+        return cached[1]
+
+@lru_cache(maxsize=None)
+def get_datadict_index(root=INSTRUMENTS_DATADICT_PATH):
+    """The index of root, shared for the rest of the run (refresh() it before use)."""
+    return DatadictIndex(root)
+
+# =========================
+# SCRD Reader
+# =========================
+class ColumnIndex:
+    """A SCRD header's columns sorted by name, for prefix lookups by bisection."""
+    def __init__(self, columns):
+        order = sorted(range(len(columns)), key=lambda i: columns[i])
+        self.columns = columns
+        self.sorted_names = [columns[i] for i in order]
+        self.sorted_positions = order  # header position of each sorted name
+
+    def match(self, prefix):
+        """Header positions of the columns starting with prefix, in header order."""
+        start = bisect.bisect_left(self.sorted_names, prefix)
+        end = start
+        while end < len(self.sorted_names) and self.sorted_names[end].startswith(prefix):
+            end += 1
+        return sorted(self.sorted_positions[start:end])
+
+    def select(self, prefixes, first=None):
+        """
+        Columns matching any of the prefixes: grouped by the first prefix each
+        matches, in header order within a group, each column once. first, if
+        given, always comes first.
+        """
+        selected = [first] if first is not None else []
+        seen = set(selected)
+        for prefix in prefixes:
+            for position in self.match(prefix):
+                col = self.columns[position]
+                if col not in seen:
+                    seen.add(col)
+                    selected.append(col)
+        return selected
+
+class ScrdReader:
+    """
+    Reads each SCRD file at most once per run.
+
+    Columns are planned first: every request registers the columns it needs
+    with require(), then the first read() of a file parses only the union of
+    them, and each request slices its columns from that one frame.
+    """
+    def __init__(self):
+        self.headers = dict()  # path -> ColumnIndex of its header
+        self.needed = dict()  # path -> columns required so far, in first-required order
+        self.frames = dict()  # path -> frame parsed with the needed columns
+
+    def header(self, path):
+        if path not in self.headers:
+            self.headers[path] = ColumnIndex(list(pd.read_csv(path, nrows=0).columns))
+        return self.headers[path]
+
+    def require(self, path, cols):
+        needed = self.needed.setdefault(path, dict())
+        new_cols = [col for col in cols if col not in needed]
+        for col in new_cols:
+            needed[col] = None
+        if new_cols and path in self.frames:
+            del self.frames[path]  # required after the first read(), parse again with them
+
+    def load(self, path):
+        """Parse a SCRD file with every column required of it so far."""
+        if path not in self.frames:
+            self.frames[path] = read_redcap(path, usecols=list(self.needed[path]))
+
+    def read(self, path, cols):
+        """The given (already required) columns of a SCRD file."""
+        if path not in self.frames:
+            self.require(path, cols)
+            self.load(path)
+        return self.frames[path][cols]
+
 # =========================
 # Main Data Sharing Class
 # =========================
 class DataSharingProtocol:
-    def __init__(self, args):
+    def __init__(self, args, registry=None):
         self.args = args
+        self.registry = registry if registry is not None else get_registry()
+        self.scrd = ScrdReader()
+        self.datadicts = None  # DatadictIndex, refreshed on first use
+        self.instrument_cols = dict()  # instrument -> session -> columns, resolved once per run
+        self.scrd_dfs = dict()  # (instrument, suffix) -> SCRD project names
+        self.scrd_files = None  # listing of SCRD_PATH, taken once per run
         self.SCRD_PATH = f"/home/data/NDClab/datasets/{self.args.name}/derivatives/preprocessed/redcap"
-        if not self.args.vars:
-            self.inputDF = pd.read_csv(self.args.input)
-            self.inputDF['redcapProject'] = self.inputDF['redcapProject'].apply(lambda x: [item.strip() for item in x.split(',')])
+        if not self.args.vars and not getattr(self.args, 'batch', None):
+            self.inputDF = read_input_csv(self.args.input)
 
     # ========== Logging ==========
     def verbose_log(self, message, color="white"):
@@ -60,64 +409,166 @@ class DataSharingProtocol:
             formatted_print(message, color)
 
     # ========== File/Column Utilities ==========
-    def save_dfs_to_xlsx(self, df_list, output_file):
-        """Save a dictionary of DataFrames to an Excel file, with each key as a sheet name."""
-        with pd.ExcelWriter(output_file) as writer:
-            for sheet_name, df in df_list.items():
-                df.to_excel(writer, sheet_name=sheet_name, index=False)
-        self.verbose_log(f"DataFrames saved to {output_file}", color="green")
+    def save_dfs(self, df_list, output_file):
+        """Save a dictionary of DataFrames with the backend for output_file's extension, one sheet/file/table per key."""
+        backend = get_export_backend(output_file)
+        # keep the extension last, pd.ExcelWriter picks its engine from it
+        root, ext = os.path.splitext(output_file)
+        tmp_file = root + ".tmp" + ext
+        remove_output(tmp_file)  # left behind by a killed run
+        start = time.perf_counter()
+        sheet_start = start
+        try:
+            for sheet_name, rows in backend(df_list, tmp_file):
+                self.verbose_log(f"Wrote {sheet_name} ({rows} rows) in {time.perf_counter() - sheet_start:.2f}s")
+                sheet_start = time.perf_counter()
+        except BaseException:
+            remove_output(tmp_file)
+            raise
+        if os.path.isdir(output_file):
+            shutil.rmtree(output_file)
+        os.replace(tmp_file, output_file)
+        formatted_print(f"Saved {len(df_list)} sheet(s) to {output_file} with {backend.__name__} in {time.perf_counter() - start:.2f}s", color="green")
 
-    def get_cols(self, name, instrument, instr_cols=None, isCol=True):
-        """Extract columns from a CSV file that match the instrument prefix."""
-        df = pd.read_csv(name)
-        cols = []
+    def select_cols(self, name, instrument, instr_cols=None, isCol=True):
+        """Columns of a SCRD file that match the instrument prefix, after record_id (from its header only)."""
         index_col = "record_id"
         if not isCol:
             self.verbose_log(f"Using instrument as column directly: {instrument}", color="cyan")
             instr_cols = [instrument]
-        for instr_col in instr_cols:
-            matched_cols = [col for col in df.columns if col.startswith(instr_col)]
-            cols.extend(matched_cols)
-        full_cols = cols
-        self.verbose_log(f"Selected columns for instrument {instrument}: {len(full_cols)}", color="yellow")
-        full_cols.insert(0, index_col)
-        return df[full_cols]
+        full_cols = self.scrd.header(name).select(instr_cols, first=index_col)
+        self.verbose_log(f"Selected columns for instrument {instrument}: {len(full_cols) - 1}", color="yellow")
+        return full_cols
+
+    def get_cols(self, name, instrument, instr_cols=None, isCol=True):
+        """Extract columns from a CSV file that match the instrument prefix."""
+        full_cols = self.select_cols(name, instrument, instr_cols, isCol)
+        self.scrd.require(name, full_cols)
+        return self.scrd.read(name, full_cols)
+
+    def combine_frames(self, sheetName, frames):
+        """
+        Outer-join a sheet's frames (one per project) on record_id, in a single concat.
+
+        A column found in more than one project is coalesced into one column,
+        keeping the first project's value where both have one; values that
+        disagree are reported.
+        """
+        if len(frames) == 1:
+            return frames[0]
+        indexed = []
+        for df in frames:
+            df = df.set_index('record_id')
+            if df.index.duplicated().any():
+                formatted_print(f"Warning: {sheetName}: record_id repeated in a project, keeping the first row of each", color="red")
+                df = df[~df.index.duplicated()]
+            indexed.append(df)
+        index = indexed[0].index
+        for df in indexed[1:]:
+            index = index.union(df.index)
+        index.name = 'record_id'
+
+        seen = dict()  # column -> number of projects it's in
+        for df in indexed:
+            for col in df.columns:
+                seen[col] = seen.get(col, 0) + 1
+        coalesced = dict()
+        conflicts = dict()  # column -> records whose projects disagree
+        for col in [col for col, count in seen.items() if count > 1]:
+            values = None
+            for df in indexed:
+                if col not in df.columns:
+                    continue
+                other = df[col].reindex(index)
+                if values is None:
+                    values = other
+                    continue
+                differs = (values.notna() & other.notna() & (values != other)).sum()
+                if differs:
+                    conflicts[col] = conflicts.get(col, 0) + differs
+                values = values.where(values.notna(), other)
+            coalesced[col] = values
+        if conflicts:
+            formatted_print(f"Warning: {sheetName}: {len(conflicts)} column(s) differ between projects, keeping the first project's values (--verbose lists them)", color="red")
+            for col, differs in conflicts.items():
+                self.verbose_log(f"  {col}: {differs} record(s)", color="red")
+
+        # columns in project order, each coalesced column where it first appears
+        pieces = [index.to_series(index=index, name='record_id')]
+        for df in indexed:
+            if not any(col in coalesced for col in df.columns):
+                pieces.append(df)
+                continue
+            run = []
+            for col in df.columns:
+                if col not in coalesced:
+                    run.append(col)
+                    continue
+                if run:
+                    pieces.append(df[run])
+                    run = []
+                if coalesced[col] is not None:
+                    pieces.append(coalesced[col])
+                    coalesced[col] = None  # placed
+            if run:
+                pieces.append(df[run])
+        sheet = pd.concat(pieces, axis=1, join='outer', sort=True)
+        sheet.index = pd.RangeIndex(len(sheet))
+        self.verbose_log(f"Combined {len(frames)} projects into sheet {sheetName}: {sheet.shape[1]} columns", color="yellow")
+        return sheet
+
+    def get_datadict_index(self):
+        if self.datadicts is None:
+            self.datadicts = get_datadict_index(INSTRUMENTS_DATADICT_PATH)
+            self.datadicts.refresh()
+        return self.datadicts
 
     def find_files_with_prefix(self, root_dir, prefix):
-        """Search for a file in a directory that starts with the given prefix and ends with '_datadict.csv'."""
+        """Find the '<prefix>_datadict.csv' file (any case) under a directory, from the instruments index."""
         full_name = prefix.lower() + "_datadict.csv"
         self.verbose_log(f"Searching for files with prefix: {full_name} in {root_dir}")
-        if not os.path.exists(root_dir):
+        try:
+            path = self.get_datadict_index().find(root_dir, full_name)
+        except FileNotFoundError:
             self.verbose_log(f"Root directory does not exist: {root_dir}")
-            raise FileNotFoundError(f"Root directory does not exist: {root_dir}")
-        for root, dirs, files in os.walk(root_dir):
-            for filename in files:
-                filename_lower = filename.lower()
-                if filename_lower.startswith(full_name):
-                    return os.path.join(root, filename)
-        return []
-
-    def find_best_match(self, instrument, all_instruments):
-        base_instrument = re.sub(r'_s\d+_r\d+_e\d+$', '', instrument)
-        for instr in all_instruments:
-            if base_instrument.startswith(instr):
-                return instr
-        return None
+            raise
+        return path if path is not None else []
+
+    def resolve_instrument(self, instrument):
+        """Longest instrument name in allMeasures.csv that prefixes instrument (minus any _sX_rX_eX)."""
+        base_instrument = SESSION_SUFFIX_RE.sub('', instrument)
+        matches = self.registry.prefixes_of(base_instrument)
+        if not matches:
+            return None
+        if len(matches) > 1 and base_instrument not in self.registry.reported_prefixes:
+            self.registry.reported_prefixes.add(base_instrument)
+            formatted_print(f"Warning: {instrument} matches instruments {matches} in allMeasures.csv, using the longest: {matches[-1]}", color="red")
+        return matches[-1]
+
+    def get_measure(self, instrument):
+        """The allMeasures.csv row for instrument, warning when it's listed with different values."""
+        rows = self.registry.get(instrument)
+        if not rows:
+            raise ValueError(f"Instrument {instrument} not found in allMeasures.csv")
+        listed = [(row['REDCap Project'], row['Data Dict']) for row in rows]
+        if len(set(listed)) > 1 and instrument not in self.registry.reported:
+            self.registry.reported.add(instrument)
+            formatted_print(f"Warning: {instrument} is ambiguous, listed in allMeasures.csv as {listed}, using the first", color="red")
+        return rows[0]
 
     def get_instrument_data_dict(self, instrument):
-        allMeasures = pd.read_csv(ALLMEASURES_PATH)
-        if re.search(r'_s\d+_r\d+_e\d+$', instrument):
-            instrument = re.sub(r'_s\d+_r\d+_e\d+$', '', instrument)
-        instrument = self.find_best_match(instrument, allMeasures['Instrument Name'].values)
-        if instrument not in allMeasures['Instrument Name'].values:
+        matched_instrument = self.resolve_instrument(instrument)
+        if matched_instrument is None:
             raise ValueError(f"Instrument {instrument} not found in allMeasures.csv")
-        datadictLink = allMeasures[allMeasures['Instrument Name'] == instrument]['Data Dict']
-        if datadictLink.empty:
+        instrument = matched_instrument
+        datadict = self.get_measure(instrument)['Data Dict']
+        if not datadict:
             raise ValueError(f"No Data Dict link found for instrument {instrument} in allMeasures.csv")
-        datadict = datadictLink.values[0]
         return os.path.join(INSTRUMENTS_DATADICT_PATH, datadict)
 
     def get_instrument_cols(self, instrument):
+        if instrument in self.instrument_cols:
+            return self.instrument_cols[instrument]
         sess = dict()
         base_name = instrument.split('_')[0]
         based_name = base_name[:-1] if base_name.endswith('p') else base_name
@@ -135,43 +586,30 @@ class DataSharingProtocol:
             datadicts = [datadict, datadict_es]
         self.verbose_log(f"Instrument list to search for datadict: {instrument_list}")
         #self.verbose_log(f"Datadict files to read: {datadicts}")
-        for i in range(len(instrument_list)):
-            inst = instrument_list[i]
-            datadict = datadicts[i]
-            ndx = pd.read_csv(datadict)
-            for _, row in ndx.iterrows():
-                suffixes = row['allowedSuffix'].split(',')
-                session_num = [re.search(r's(\d+)', val).group(1) for val in suffixes]
-                suffixes = [f"s{num}" for num in session_num]
-                for suffix in suffixes:
-                    if suffix not in sess:
-                        sess[suffix] = []
-                    col_name = f"{row['variable']}_{suffix}"
-                    sess[suffix].append(col_name)
+        for datadict in datadicts:
+            for suffix, cols in self.get_datadict_index().get_sessions(datadict).items():
+                sess.setdefault(suffix, []).extend(cols)
         self.verbose_log(f"Total columns for instrument {instrument}: {len(sess)}", color="yellow")
+        self.instrument_cols[instrument] = sess
         return sess
 
     def get_scrd_df(self, instrument, suffix=""):
-        allMeasures = pd.read_csv(ALLMEASURES_PATH)
+        key = (instrument, suffix)
+        if key in self.scrd_dfs:
+            return self.scrd_dfs[key]
         self.verbose_log(f"Getting SCRD DF for instrument: {instrument} with suffix: {suffix}", color="blue")
-        if re.search(r'_s\d+_r\d+_e\d+$', instrument):
-            instrument_prefix = re.sub(r'_s\d+_r\d+_e\d+$', '', instrument)
-            matched_instruments = [inst for inst in allMeasures['Instrument Name'].values if instrument_prefix.startswith(inst)]
-            if not matched_instruments:
+        if SESSION_SUFFIX_RE.search(instrument):
+            matched_instrument = self.resolve_instrument(instrument)
+            if matched_instrument is None:
                 raise ValueError(f"No matching instrument found for {instrument} in allMeasures.csv")
-            if len(matched_instruments) > 1:
-                self.verbose_log(f"Multiple matched instruments for {instrument}: {matched_instruments}", color="red")
-                raise ValueError(f"Multiple matched instruments for {instrument}: {matched_instruments}")
-            if len(matched_instruments) == 1:
-                instrument = matched_instruments[0]
-            self.verbose_log(f"Matched instrument for {instrument}: {instrument}", color="cyan")
-        if instrument not in allMeasures['Instrument Name'].values:
-            raise ValueError(f"Instrument {instrument} not found in allMeasures.csv")
-        redCapProject = allMeasures[allMeasures['Instrument Name'] == instrument]['REDCap Project']
-        if redCapProject.empty:
+            self.verbose_log(f"Matched instrument for {instrument}: {matched_instrument}", color="cyan")
+            instrument = matched_instrument
+        redCapProject = self.get_measure(instrument)['REDCap Project']
+        if not redCapProject:
             raise ValueError(f"No REDCap Project found for instrument {instrument} in allMeasures.csv")
-        projectName = redCapProject.values[0].replace('_', '') if '_' in redCapProject.values[0] else redCapProject.values[0]
+        projectName = redCapProject.replace('_', '')
         projectName = projectName + suffix
+        self.scrd_dfs[key] = [projectName]
         return [projectName]
 
     def get_latest_file(self, files, key):
@@ -185,11 +623,19 @@ class DataSharingProtocol:
             raise FileNotFoundError(f"No file found for {key}")
         return latest_file
 
+    def get_scrd_files(self):
+        if self.scrd_files is None:
+            self.scrd_files = os.listdir(self.SCRD_PATH)
+        return self.scrd_files
+
     # ========== Main Data Sharing Logic ==========
-    def data_sharing(self):
-        df_list = dict()
-        for _, row in self.inputDF.iterrows():
-            scrdFiles = os.listdir(self.SCRD_PATH)
+    # requests are planned first (sheet -> [(SCRD file, columns), ...]), registering their
+    # columns with self.scrd so each SCRD file is parsed once, then built and saved
+
+    def plan_input(self, inputDF):
+        planned = dict()
+        for _, row in inputDF.iterrows():
+            scrdFiles = self.get_scrd_files()
             instrumentName = row["columnName"]
             if row['isColumn']:
                 instr_cols = [instrumentName]
@@ -203,17 +649,15 @@ class DataSharingProtocol:
                 scrdFile = self.get_latest_file(scrdFiles, dfName.lower())
                 scrdFilePath = os.path.join(self.SCRD_PATH, scrdFile)
                 self.verbose_log(f"Reading file: {scrdFile}")
-                if sheetName not in df_list:
-                    df_list[sheetName] = self.get_cols(scrdFilePath, instrumentName, instr_cols, row['isColumn'])
-                else:
-                    new_df = self.get_cols(scrdFilePath, instrumentName, instr_cols, row['isColumn'])
-                    df_list[sheetName] = pd.merge(df_list[sheetName], new_df, on='record_id', how='outer')
-        self.save_dfs_to_xlsx(df_list, self.args.output)
+                cols = self.select_cols(scrdFilePath, instrumentName, instr_cols, row['isColumn'])
+                self.scrd.require(scrdFilePath, cols)
+                planned.setdefault(sheetName, []).append((scrdFilePath, cols))
+        return planned
 
-    def direct_data_sharing(self, vars):
-        df_list = dict()
+    def plan_vars(self, vars):
+        planned = dict()
         for variable in vars:
-            scrdFiles = os.listdir(self.SCRD_PATH)
+            scrdFiles = self.get_scrd_files()
             instrumentName = variable
             suffix = ""
             if re.search(r'_s\d+_r\d+_e\d+$', instrumentName):
@@ -235,13 +679,87 @@ class DataSharingProtocol:
                 scrdFile = self.get_latest_file(scrdFiles, dfName.lower())
                 scrdFilePath = os.path.join(self.SCRD_PATH, scrdFile)
                 self.verbose_log(f"Reading file: {scrdFile}")
-                if sheetName not in df_list:
-                    df_list[sheetName] = self.get_cols(scrdFilePath, instrumentName, instr_cols)
-        self.save_dfs_to_xlsx(df_list, self.args.output)
+                if sheetName not in planned:
+                    cols = self.select_cols(scrdFilePath, instrumentName, instr_cols)
+                    self.scrd.require(scrdFilePath, cols)
+                    planned[sheetName] = [(scrdFilePath, cols)]
+        return planned
+
+    def build_sheets(self, planned):
+        df_list = dict()
+        for sheetName, sources in planned.items():
+            frames = [self.scrd.read(scrdFilePath, cols) for scrdFilePath, cols in sources]
+            df_list[sheetName] = self.combine_frames(sheetName, frames)
+        return df_list
+
+    def write_output(self, planned, output_file):
+        self.save_dfs(self.build_sheets(planned), output_file)
+
+    def data_sharing(self):
+        self.write_output(self.plan_input(self.inputDF), self.args.output)
+
+    def direct_data_sharing(self, vars):
+        self.write_output(self.plan_vars(vars), self.args.output)
+
+    def batch_data_sharing(self, batch):
+        """
+        Run many requests together: every SCRD file is read once, then outputs are written concurrently.
+
+        A request that can't be planned, or that needs a SCRD file that can't be
+        read, is reported and skipped; the other outputs are still written.
+        """
+        requests = read_batch(batch, self.args.output)
+        start = time.perf_counter()
+        plans = []
+        failed = []
+        for input_csv, vars, output in requests:
+            formatted_print(f"Planning {output} from {input_csv or ','.join(vars)}", color="blue")
+            try:
+                get_export_backend(output)
+                planned = self.plan_input(read_input_csv(input_csv)) if input_csv else self.plan_vars(vars)
+            except Exception as e:
+                formatted_print(f"Error planning {output}: {e}", color="red")
+                failed.append(output)
+                continue
+            plans.append((output, planned))
+        with ThreadPoolExecutor(max_workers=self.args.threads) as executor:
+            # load every SCRD file up front, so the output threads only slice cached frames
+            load_start = time.perf_counter()
+            load_errors = dict()  # path -> exception
+            futures = {executor.submit(self.scrd.load, path): path for path in list(self.scrd.needed)}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    formatted_print(f"Error reading {futures[future]}: {e}", color="red")
+                    load_errors[futures[future]] = e
+            self.verbose_log(f"Read {len(self.scrd.needed)} SCRD file(s) in {time.perf_counter() - load_start:.2f}s", color="yellow")
+            futures = dict()
+            for output, planned in plans:
+                unreadable = sorted(set(path for sources in planned.values() for path, _ in sources if path in load_errors))
+                if unreadable:
+                    formatted_print(f"Not writing {output}, it needs unreadable SCRD file(s) {', '.join(unreadable)}", color="red")
+                    failed.append(output)
+                    continue
+                futures[executor.submit(self.write_output, planned, output)] = output
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    formatted_print(f"Error writing {futures[future]}: {e}", color="red")
+                    failed.append(futures[future])
+        formatted_print(f"Batch of {len(requests)} request(s) done in {time.perf_counter() - start:.2f}s", color="green")
+        if failed:
+            sys.exit(f"{len(failed)} output(s) failed: {', '.join(failed)}")
 
     # ========== Main Entrypoint ==========
     def run(self):
         formatted_print("Starting Data Sharing Protocol...", color="green")
+        if self.args.batch:
+            self.batch_data_sharing(self.args.batch)
+            formatted_print("Data Sharing Protocol completed", color="green")
+            return
+        get_export_backend(self.args.output)  # fail before doing the work
         if self.args.vars:
             vars = [var.strip() for var in self.args.vars.split(',')]
             self.direct_data_sharing(vars)
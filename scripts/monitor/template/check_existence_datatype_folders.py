@@ -5,6 +5,12 @@ from os import listdir, walk
 import pathlib
 import re
 
+sys.path.append("/home/data/NDClab/tools/lab-devOps/scripts/redcap_cache")
+try:
+    from redcap_cache import read_redcap
+except ImportError:  # lab-devOps not mounted, parse directly
+    read_redcap = pd.read_csv
+
 if __name__ == "__main__":
     dataset = sys.argv[1]
     redcaps = sys.argv[2]
@@ -65,7 +71,7 @@ if __name__ == "__main__":
                 break
         if not found_rc:
             sys.exit("Can't find redcap with name " + vals[0] +", exiting.")
-        rc_df = pd.read_csv(redcap, index_col = vals[2])
+        rc_df = read_redcap(redcap, index_col = vals[2])
         rc_var = vals[1]
         subs_w_data = list(rc_df[rc_df[rc_var+"_"+session+"_e1_complete"] == 2].index) #? always be a _complete column?
         tracker_df.loc[subs_w_data, visit+'_status_'+session+'_e1'] = 1
@@ -8,6 +8,12 @@ import math
 import datetime
 from collections import defaultdict
 
+sys.path.append("/home/data/NDClab/tools/lab-devOps/scripts/redcap_cache")
+try:
+    from redcap_cache import read_redcap
+except ImportError:  # lab-devOps not mounted, parse directly
+    read_redcap = pd.read_csv
+
 # list hallMonitor key
 
 completed = "_complete"
@@ -171,7 +177,7 @@ def parent_columns(datadict_df):
                 parent_info.setdefault(rc_filename,[]).append(row["variable"])
             else:
                 continue
-            rc_df = pd.read_csv(all_redcap_paths[rc_filename])
+            rc_df = read_redcap(all_redcap_paths[rc_filename])
             parent_ids = list(rc_df.loc[:, rc_variable])
             for id in parent_ids:
                 if re.search(study_no + '[089](\d{4})', str(id)):
@@ -196,7 +202,7 @@ def parent_columns(datadict_df):
                 parent_info.setdefault(rc_filename,[]).append(row["variable"])
             else:
                 continue
-            rc_df = pd.read_csv(all_redcap_paths[rc_filename], index_col="record_id")
+            rc_df = read_redcap(all_redcap_paths[rc_filename], index_col="record_id")
             for col in rc_df.columns:
                 lang_re = re.match(rc_variable + "_(s[0-9]+_r[0-9]+_e[0-9]+)", col)
                 if lang_re:
@@ -271,12 +277,12 @@ if __name__ == "__main__":
                 sys.exit(c.RED + "Error: can't find redcap specified in datadict " + expected_rc + ", exiting." + c.ENDC)
             if "id_column" in redcheck_columns[expected_rc].keys():
                 id_col = redcheck_columns[expected_rc]["id_column"]
-                for column in pd.read_csv(redcap_path).columns:
+                for column in read_redcap(redcap_path).columns:
                     if column.startswith(id_col):
-                        all_rc_dfs[expected_rc] = pd.read_csv(redcap_path, index_col = column)
+                        all_rc_dfs[expected_rc] = read_redcap(redcap_path, index_col = column)
             else:
                 id_col = "record_id"
-                all_rc_dfs[expected_rc] = pd.read_csv(redcap_path, index_col = id_col)
+                all_rc_dfs[expected_rc] = read_redcap(redcap_path, index_col = id_col)
             # If hallMonitor passes "redcap" arg, data exists and passed checks 
             vals = pd.read_csv(redcap_path, header=None, nrows=1).iloc[0,:].value_counts()
             # Exit if duplicate column names in redcap
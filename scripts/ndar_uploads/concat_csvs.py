@@ -1,16 +1,134 @@
+import csv
 import os
 import re
+import shutil
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from os.path import isdir, join
 
 ### combines identically-named .csv files in multiple folders (up to sX_rX_eX) into single .csv files for NIH uploads
+### (both the full "_incomplete.csv" files and the "_delta.csv" files from gen_NDAR_csvs.py --ledger)
 ###
-### USAGE: python3 concat_csvs.py <folder1,folder2,folder3...> <output folder>
+### with --dedup, only the first row for each (src_subject_id, timepoint_label) is kept, in folder order
+### (structures without a timepoint_label are keyed on interview_date instead)
+###
+### USAGE: python3 concat_csvs.py <folder1,folder2,folder3...> <output folder> [--dedup]
+
+COPY_BLOCK_SIZE = 16 * 1024 * 1024  # bytes per read/write when copying data rows
+FILE_RE = r"^(.+)_s\d+_r\d+_e\d+_(incomplete|delta)\.csv$"
+DEDUP_KEYS = ["src_subject_id", "timepoint_label"]
+DEDUP_FALLBACK_KEY = "interview_date"
+
+
+def get_structure_files(folders):
+    """
+    Find each structure's CSV in every folder.
+
+    Structures missing from any of the folders are reported and left out.
+
+    Returns:
+        dict[tuple[str, str], list[str]]: (structure, "incomplete" or "delta")
+            -> the structure's file in each folder, in folder order.
+    """
+    structure_files = {}
+    for folder in folders:
+        for file in sorted(os.listdir(folder)):
+            file_re = re.match(FILE_RE, file)
+            if file_re:
+                structure_files.setdefault(file_re.groups(), {})[folder] = join(folder, file)
+
+    for structure, kind in sorted(structure_files.keys()):
+        missing = [
+            folder for folder in folders if folder not in structure_files[(structure, kind)]
+        ]
+        if missing:
+            print(f"Skipping {structure} ({kind}), missing from {', '.join(missing)}")
+            structure_files.pop((structure, kind))
+    return {
+        key: [files[folder] for folder in folders] for key, files in structure_files.items()
+    }
+
+
+def read_header(file):
+    """
+    Return the first two lines of an NDAR CSV ("<structure>,01" and the column header).
+    """
+    with open(file, "r", newline="") as f:
+        return f.readline(), f.readline()
+
+
+def concat_structure(out_file, files, dedup=False):
+    """
+    Concatenate one structure's CSVs into out_file.
+
+    The inputs' two header lines must match; data rows are copied in large
+    blocks, or row by row through a set of seen keys with dedup.
+
+    Returns:
+        tuple[int, int]: Number of rows written and of duplicate rows dropped
+            (rows are only counted with dedup).
+
+    Raises:
+        ValueError: If the headers don't match, or there's no column to dedup on.
+    """
+    header = read_header(files[0])
+    for file in files[1:]:
+        if read_header(file) != header:
+            raise ValueError(f"header of {file} doesn't match {files[0]}")
+
+    tmp_file = out_file + ".tmp"
+    try:
+        counts = copy_rows(tmp_file, header, files, dedup)
+        os.replace(tmp_file, out_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    return counts
+
+
+def copy_rows(tmp_file, header, files, dedup):
+    """
+    Write header and the data rows of files to tmp_file, for concat_structure.
+    """
+    rows_written = 0
+    rows_dropped = 0
+    with open(tmp_file, "w", newline="") as out_f:
+        out_f.writelines(header)
+        if dedup:
+            columns = next(csv.reader([header[1]]))
+            keys = DEDUP_KEYS
+            if DEDUP_KEYS[1] not in columns:
+                keys = [DEDUP_KEYS[0], DEDUP_FALLBACK_KEY]
+            if not all(key in columns for key in keys):
+                raise ValueError(f"{files[0]} has no {' or '.join(keys)} column to dedup on")
+            key_idx = [columns.index(key) for key in keys]
+            writer = csv.writer(out_f, lineterminator="\n")
+            seen = set()
+        for file in files:
+            with open(file, "r", newline="") as in_f:
+                in_f.readline()
+                in_f.readline()
+                if not dedup:
+                    shutil.copyfileobj(in_f, out_f, COPY_BLOCK_SIZE)
+                    continue
+                for row in csv.reader(in_f):
+                    key = tuple(row[idx] for idx in key_idx)
+                    if key in seen:
+                        rows_dropped += 1
+                        continue
+                    seen.add(key)
+                    writer.writerow(row)
+                    rows_written += 1
+    return rows_written, rows_dropped
 
 
 if __name__ == "__main__":
+    dedup = "--dedup" in sys.argv
+    if dedup:
+        sys.argv.remove("--dedup")
     if len(sys.argv) != 3:
-        print("python3 concat_csvs.py <folder1,folder2,folder3...> <output folder>")
+        print("python3 concat_csvs.py <folder1,folder2,folder3...> <output folder> [--dedup]")
         exit()
 
     folders = sys.argv[1]
@@ -18,39 +136,34 @@ if __name__ == "__main__":
     folders = folders.split(",")
     if not isdir(out_path):
         os.mkdir(out_path)
-    files_in_common = os.listdir(folders[0])
-    unique_files = {}
-    for file in files_in_common:
-        file_re = re.match(r"^(.+)_s\d+_r\d+_e\d+_incomplete.csv", file)
-        if file_re:
-            unique_files[file_re.group(1)] = [join(folders[0], file)]
-    if len(unique_files) == 0:
+    structure_files = get_structure_files(folders)
+    if len(structure_files) == 0:
         sys.exit('No unique files ending in "sX_rX_eX_incomplete.csv" seen in folders')
-    for i in range(1, len(folders)):
-        folder = folders[i]
-        print(folder)
-        files = os.listdir(folder)
-        files_in_folder = []
-        for file in files:
-            file_re = re.match(r"^(.+)_s\d+_r\d+_e\d+_incomplete.csv", file)
-            if file_re:
-                files_in_folder.append(file_re.group(1))
-                if file_re.group(1) not in unique_files.keys():
-                    unique_files.pop(file, None)
-                else:
-                    unique_files[file_re.group(1)].append(join(folder, file))
-    file_dict = {}
-    for filename_base in unique_files.keys():
-        first_file = True
-        with open(join(out_path, filename_base + "_combined_incomplete.csv"), "w") as f:
-            for file in unique_files[filename_base]:
-                with open(file, "r") as file_dict[i]:
-                    lines = file_dict[i].readlines()
-                    if first_file:
-                        lines_to_write = range(0, len(lines))
-                        first_file = False
-                    else:
-                        lines_to_write = range(2, len(lines))
-                    for j in lines_to_write:
-                        f.write(lines[j])
-        print("wrote out " + join(out_path, filename_base + "_combined_incomplete.csv"))
+
+    with ProcessPoolExecutor() as executor:
+        futures = {
+            join(out_path, structure + "_combined_" + kind + ".csv"): executor.submit(
+                concat_structure,
+                join(out_path, structure + "_combined_" + kind + ".csv"),
+                files,
+                dedup,
+            )
+            for (structure, kind), files in sorted(structure_files.items())
+        }
+        failed = []
+        for out_file, future in futures.items():
+            try:
+                rows_written, rows_dropped = future.result()
+            except Exception as err:  # report it and carry on with the other structures
+                print(f"Error: {err}, not writing {out_file}")
+                failed.append(out_file)
+                continue
+            if dedup:
+                print(
+                    f"wrote out {out_file} ({rows_written} rows, "
+                    f"dropped {rows_dropped} duplicate rows)"
+                )
+            else:
+                print("wrote out " + out_file)
+    if failed:
+        sys.exit(f"Error: {len(failed)} structure(s) not written")
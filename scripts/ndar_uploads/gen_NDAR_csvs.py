@@ -1,12 +1,36 @@
+import csv
+import fcntl
+import hashlib
+import io
 import json
 import math
+import multiprocessing
 import os
 import re
+import shutil
+import stat
 import sys
-from datetime import datetime
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "redcap_cache"))
+try:
+    from redcap_cache import read_redcap
+except ImportError:  # lab-devOps checkout without the cache, parse directly
+    read_redcap = pd.read_csv
+try:
+    import pyarrow as pa
+    from pyarrow import ipc
+except ImportError:  # workers get pickled copies of the frames instead
+    pa = None
+
+CSV_CHUNKSIZE = 10000  # rows per to_csv chunk when writing NDAR CSVs
+PENDING_SUFFIX = "_pending.csv"  # delta rows not yet confirmed as submitted, see save_delta
+HASH_BLOCK_SIZE = 1024 * 1024
+
 
 # Copied from hallMonitor2/hallmonitor/hmutils
 def get_new_redcaps(basedir):
@@ -47,7 +71,7 @@ def get_new_redcaps(basedir):
         newest_time = None
         newest_file = None
         for file in redcaps:
-            if file.startswith(unique_rc):
+            if file.startswith(unique_rc + "_DATA_"):  # not e.g. <stem>remote_DATA_
                 file_time = re.search(time_stamp_re, file)
                 if file_time:
                     file_time = file_time.group()
@@ -66,9 +90,125 @@ def get_new_redcaps(basedir):
     return sorted(newest_files)
 
 
-def get_redcaps(datadict_df, redcaps, ndar_json):
+def get_needed_columns(ndar_json, sre):
+    """
+    Collect the REDCap columns a mapping spec reads, by REDCap name.
+
+    Every rc_variable is collected as-is and with "_<sre>" appended, along with
+    the "es" variant of each, since which form is read depends on the column
+    ("sessionless", "parent", interview date/age...). Race checkboxes and the
+    ADIS diagnosis slots are matched by pattern.
+
+    Returns:
+        dict[str, re.Pattern]: Maps each REDCap name to a pattern that fully
+            matches the names of the columns to load from it.
+    """
+    patterns = {}
+
+    def add_variable(redcap, rc_variable, suffix=""):
+        for col in [rc_variable, rc_variable + "_" + sre]:
+            for variant in [col, Column(col).coles]:
+                patterns.setdefault(redcap, []).append(re.escape(variant) + suffix)
+
+    for ndar_csv in ndar_json.keys():
+        for ndar_col, col_json in ndar_json[ndar_csv]["req_columns"].items():
+            if "redcap" not in col_json.keys():
+                continue
+            redcap = col_json["redcap"]
+            if ndar_csv == "adis_v01" and ndar_col == "pd_pdx":
+                patterns.setdefault(redcap, []).append(
+                    r"adis_fn_dx\d+_(?:lb|sp)_" + re.escape(sre)
+                )
+            if "rc_variable" in col_json.keys():
+                rc_variable = col_json["rc_variable"]
+                if ndar_col == "race":
+                    add_variable(redcap, rc_variable, suffix=r"_+\d+")
+                else:
+                    add_variable(redcap, rc_variable)
+                if ndar_csv == "all" and ndar_col == "src_subject_id":
+                    # checked against "<rc_variable>_<sre>_complete" when not sessionless
+                    add_variable(redcap, rc_variable + "_" + sre + "_complete")
+            for comp in col_json.get("components", []):
+                add_variable(redcap, comp)
+            for sub_key in ["conditional_column", "child_variable"]:
+                if sub_key in col_json.keys():
+                    sub_json = col_json[sub_key]
+                    add_variable(sub_json["redcap"], sub_json["rc_variable"])
+    return {
+        redcap: re.compile("|".join(sorted(set(redcap_patterns))))
+        for redcap, redcap_patterns in patterns.items()
+    }
+
+
+def coalesce_records(rc_dfs, rc_name):
+    """
+    Merge exports of the same REDCap into one row per record_id.
+
+    For each record and column the newest export's non-empty value is kept,
+    falling back to older exports where it's empty. Columns where exports
+    disagree on a non-empty value are reported.
+
+    Args:
+        rc_dfs (list[tuple[str, pd.DataFrame]]): (export timestamp, export)
+            pairs; timestamps like "2024-09-01_1010" compare chronologically.
+        rc_name (str): REDCap name, for the conflict report.
+
+    Returns:
+        pd.DataFrame: A uniquely indexed frame, in the order records first
+            appear in rc_dfs.
+    """
+    record_ids = pd.Index(
+        np.concatenate([rc_df.index for _, rc_df in rc_dfs]), name="record_id"
+    ).unique()
+    newest_first = sorted(rc_dfs, key=lambda rc: rc[0], reverse=True)
+    combined = pd.concat([rc_df for _, rc_df in newest_first])
+    if combined.index.is_unique:
+        return combined.reindex(record_ids)
+    records = combined.groupby(level=0, sort=False)
+    conflicts = records.nunique() > 1
+    for col in conflicts.columns[conflicts.any()]:
+        conflict_ids = [str(record_id) for record_id in conflicts.index[conflicts[col]]]
+        print(
+            f"Warning: {rc_name} exports disagree on {col} for record(s) "
+            + ", ".join(conflict_ids[:10])
+            + (f" and {len(conflict_ids) - 10} more" if len(conflict_ids) > 10 else "")
+            + ", keeping the newest export's value."
+        )
+    return records.first().reindex(record_ids)
+
+
+def read_redcap_columns(redcap_paths, needed_columns):
+    """
+    Read only the needed columns of one or more exports of the same REDCap.
+
+    Args:
+        redcap_paths (list[str]): Exports sharing a name (e.g. the in-person
+            and remote-only REDCaps).
+        needed_columns (re.Pattern): Matches the names of the columns to load.
+
+    Returns:
+        list[tuple[str, pd.DataFrame]]: (export timestamp, needed columns
+            indexed by record_id) for each export, for coalesce_records.
+    """
+    rc_dfs = []
+    for redcap_path in redcap_paths:
+        header = pd.read_csv(redcap_path, nrows=0).columns
+        usecols = [
+            col for col in header if col == "record_id" or needed_columns.fullmatch(col)
+        ]
+        export_time = re.search(r"\d{4}-\d{2}-\d{2}_\d{4}", os.path.basename(redcap_path))
+        rc_dfs.append(
+            (
+                export_time.group() if export_time else "",
+                read_redcap(redcap_path, index_col="record_id", usecols=usecols),
+            )
+        )
+    return rc_dfs
+
+
+def get_redcaps(datadict_df, redcaps, needed_columns):
     df = datadict_df
-    redcaps_dict = {}
+    rcs_to_look_for = []
     for _, row in df.iterrows():
         if row["dataType"] not in [
             "consent",
@@ -80,172 +220,348 @@ def get_redcaps(datadict_df, redcaps, ndar_json):
         if "file:" in prov and "variable:" in prov:
             idx = prov.index("file:")
             rc_filename = prov[idx + 1].strip('";,')
-            if rc_filename not in redcaps_dict.keys():
-                redcaps_dict[rc_filename] = pd.DataFrame()
+            if rc_filename not in rcs_to_look_for:
+                rcs_to_look_for.append(rc_filename)
         else:
             continue
-    rcs_to_look_for = redcaps_dict.keys()
-
 
+    redcaps_dict = {}
     for expected_rc in rcs_to_look_for:
-        present = False
-        for redcap in redcaps:
-            if expected_rc in os.path.basename(redcap.lower()):
-                # We already know that our REDCaps are legal after data monitoring; we'll just
-                # join the ones that share a name (in the case of remote-only & in-person REDCaps)
-                present = True
-                prev_df = redcaps_dict.get(expected_rc, pd.DataFrame())
-                new_df = pd.read_csv(redcap, index_col="record_id")
-                redcaps_dict[expected_rc] = pd.concat([prev_df, new_df])
-                
-        if not present:
+        # We already know that our REDCaps are legal after data monitoring; we'll just
+        # merge the ones that share a name (in the case of remote-only & in-person REDCaps)
+        matching_redcaps = [
+            redcap for redcap in redcaps if expected_rc in os.path.basename(redcap.lower())
+        ]
+        if not matching_redcaps:
             sys.exit(
                 "Error: can't find redcap specified in datadict "
                 + expected_rc
                 + ", exiting."
             )
+        if expected_rc not in needed_columns.keys():
+            continue  # nothing in the mapping reads from this REDCap
+        redcaps_dict[expected_rc] = coalesce_records(
+            read_redcap_columns(matching_redcaps, needed_columns[expected_rc]), expected_rc
+        )
     return redcaps_dict
 
+
+def remap_ids(ids, digit):
+    """
+    Swap the third digit of each subject ID, e.g. 3000001 <-> 3080001.
+
+    Child IDs use 0 in that position and parent IDs use 8 or 9, so this is how
+    rows are aligned between child and parent REDCaps.
+
+    Args:
+        ids (Iterable[int]): Subject IDs to remap.
+        digit (str | int): Digit to put in the third position.
+
+    Returns:
+        pd.Index: The remapped IDs, in the same order as the input.
+    """
+    ids = pd.Index(ids).astype(str)
+    return pd.Index((ids.str[0:2] + str(digit) + ids.str[3:]).astype(int))
+
+
+def to_child_rows(data, child_ids):
+    """
+    Key REDCap rows (child or parent IDs) by child ID and align them to child_ids.
+
+    If several rows land on the same child (e.g. XX8XXXX and XX9XXXX parents),
+    the last non-empty value wins, as it did when rows were written one by one.
+    """
+    data = data.set_axis(remap_ids(data.index, 0), axis=0)
+    if not data.index.is_unique:
+        data = data.groupby(level=0).last()
+    return data.reindex(child_ids)
+
+
 def diff_month(d1, d2):
-    month = 1
-    if d1.day < d2.day:
-        month = 1
-    else:
-        month = 0
-    return (d1.year - d2.year) * 12 + d1.month - d2.month - month
+    """
+    Whole months from d2 to d1, one less when d1's day-of-month is earlier.
 
-def get_age(old_interview_date, interview_date):
-    date_format = "%m/%d/%Y"
-    dob = datetime.strptime(old_interview_date, date_format)
-    interview_dt = datetime.strptime(interview_date, date_format)
-    age_in_months = diff_month(interview_dt, dob)
-    return age_in_months
+    Both arguments are datetime Series; rows where either date is missing
+    come out as NaN.
+    """
+    month = (d1.dt.day < d2.dt.day).astype(int)
+    return (d1.dt.year - d2.dt.year) * 12 + d1.dt.month - d2.dt.month - month
+
+
+def coalesce_es(rc_df, rc_variable):
+    """
+    Return a REDCap column, falling back to its "es" variant where it's empty.
+    """
+    rc_column = Column(rc_variable)
+    values = rc_df[rc_column.col]
+    if rc_column.coles in rc_df.columns:
+        values = values.fillna(rc_df[rc_column.coles])
+    return values
+
+
+def parse_redcap_dates(values):
+    """
+    Parse REDCap "YYYY-MM-DD[ HH:MM]" strings into a datetime Series (NaT if empty).
+    """
+    dates = values.dropna().astype(str).str.split(" ").str[0]
+    return pd.to_datetime(dates, format="%Y-%m-%d").reindex(values.index)
 
 
-def map_interview_age(ndar_df,redcaps_dict, ndar_json, sub_variable_json=None):
+def map_interview_age(ndar_df, redcaps_dict, ndar_json, sub_variable_json=None):
+    """
+    Fill ndar_df's interview_age (in months) from the REDCap age variable.
 
-    rc = ndar_json["redcap"] # where age is stored
-    print(redcaps_dict.keys())
-    rc_df = redcaps_dict[ndar_json["redcap"]]
-    rc_variable = ndar_json["rc_variable"]
-    rc_variable = Column(rc_variable).col
-    rc_variable_es = Column(rc_variable).coles
+    If sub_variable_json points at an earlier interview date (e.g. the s1
+    timestamp for a later session), the months elapsed between that date and
+    ndar_df's interview_date are added to the age. interview_date must already
+    be mapped.
+    """
+    rc = ndar_json["redcap"]  # where age is stored
+    rc_df = redcaps_dict[rc]
+    age_df = coalesce_es(rc_df, ndar_json["rc_variable"]).to_frame("interview_age")
 
-    sub_rc_df = None # where sub variable interview date is stored
-    sub_rc_variable = None
-    sub_rc_variable_es = None
+    if sub_variable_json is not None:
+        # where sub variable interview date is stored
+        sub_rc_df = redcaps_dict[sub_variable_json["redcap"]]
+        old_dates = coalesce_es(sub_rc_df, sub_variable_json["rc_variable"])
+        age_df = age_df.join(old_dates.rename("old_interview_date"), how="left")
 
+    age_df = to_child_rows(age_df, ndar_df.index)
+    interview_age = np.trunc(pd.to_numeric(age_df["interview_age"]))
     if sub_variable_json is not None:
-        sub_rc = sub_variable_json["redcap"]
-        sub_rc_variable = sub_variable_json["rc_variable"]
-        sub_rc_variable = Column(sub_rc_variable).col
-        sub_rc_variable_es = Column(sub_rc_variable).coles
-        rc_df = redcaps_dict[rc]
-        if rc==sub_rc:
-            sub_rc_df = rc_df
-        else:
-            sub_rc_df = redcaps_dict[sub_rc]
-    
-    for id in rc_df.index:
-        child_id = int(str(id)[0:2] + "0" + str(id)[3:])
-        interview_age = rc_df.loc[id, rc_variable]
-        if pd.isna(interview_age) and rc_variable_es in rc_df.columns:
-            interview_age = rc_df.loc[id, rc_variable_es]
-        if not pd.isna(interview_age):
-            interview_age = int(interview_age)
-        if sub_rc_df is not None:
-            old_interview_date = sub_rc_df.loc[id, sub_rc_variable]
-            if pd.isna(old_interview_date) and sub_rc_variable_es in sub_rc_df.columns:
-                old_interview_date = sub_rc_df.loc[id, sub_rc_variable_es]
-            if pd.isna(old_interview_date):
-                continue
-            if child_id not in ndar_df.index:
-                continue
-            current_date = ndar_df.loc[child_id, "interview_date"]
-            old_interview_date = old_interview_date.split(" ")[0]
-            old_interview_date = datetime.strptime(old_interview_date, "%Y-%m-%d").strftime("%m/%d/%Y")
-            current_date_fixed = current_date
-            months_after = get_age(old_interview_date, current_date_fixed)
-            interview_age += months_after
-        if child_id in ndar_df.index:
-            ndar_df.loc[child_id, "interview_age"] = interview_age          
+        old_interview_date = parse_redcap_dates(age_df["old_interview_date"])
+        current_date = pd.to_datetime(ndar_df["interview_date"])
+        interview_age = interview_age + diff_month(current_date, old_interview_date)
+    ndar_df["interview_age"] = interview_age.astype("Int64")
+
+
+def get_race_codes(rc_df, race_col_base, race_json):
+    """
+    Select the race checkbox columns of a REDCap and decode their race codes.
+
+    Checkbox columns look like ``demo_d_race_s1_r1_e1___10`` (or the "es"
+    variant), where the trailing number is the race code. Each code is looked
+    up in the "race_codes" table of the race column's JSON.
 
-    
+    Returns:
+        dict[str, str]: Maps each race checkbox column to its race label.
+    """
+    if "race_codes" not in race_json.keys():
+        sys.exit("Error: no race_codes table specified for race column, exiting.")
+    race_codes = race_json["race_codes"]
+    race_re = re.compile(
+        rf"(?:{re.escape(race_col_base.col)}|{re.escape(race_col_base.coles)})_+(?P<race>\d+)"
+    )
+    race_labels = {}
+    for col in rc_df.columns:
+        race_match = race_re.fullmatch(col)
+        if not race_match:
+            continue
+        race_num = race_match.group("race")
+        if race_num not in race_codes.keys():
+            sys.exit(
+                "Error: race code " + race_num + " of column " + col
+                + " not found in race_codes, exiting."
+            )
+        race_labels[col] = race_codes[race_num]
+    return race_labels
 
 
 def map_race(
-    ndar_df, ndar_json, redcap, race_col, sre, col_name, sessionless=False, parent=False
+    ndar_df, race_json, redcap, race_col, sre, col_name, sessionless=False, parent=False
 ):
-    race_dict = {
-        "10": "White",
-        "11": "Black or African American",
-        "12": "American Indian/Alaska Native",
-        "13": "American Indian/Alaska Native",
-        "14": "Hawaiian or Pacific Islander",
-        "15": "Hawaiian or Pacific Islander",
-        "16": "Hawaiian or Pacific Islander",
-        "17": "Hawaiian or Pacific Islander",
-        "18": "Asian",
-        "19": "Asian",
-        "20": "Asian",
-        "21": "Asian",
-        "22": "Asian",
-        "23": "Asian",
-        "24": "Asian",
-        "25": "Other Non-White",
-        "999": "Unknown or not reported",
-    }
     rc_df = redcaps_dict[redcap]
     if sessionless:
         race_col_base = Column(race_col)
     else:
         race_col_base = Column(race_col + "_" + sre)
-    race_cols = []
-    for col in rc_df.columns:
-        if col.startswith(race_col_base.col) or col.startswith(race_col_base.coles):
-            race_cols.append(col)
-    for child_id in ndar_df.index:
-        if parent:
-            id = int(str(child_id)[0:2] + "8" + str(child_id)[3:])
-        else:
-            id = child_id
-        sum = 0
-        for col in race_cols:
-            sum += rc_df.loc[id, col]
-        if sum == 1:
-            for col in race_cols:
-                if rc_df.loc[id, col] == 1:
-                    race_num = re.fullmatch(
-                        r"demo(?:es)?_[de]_race_s\d+_r\d+_e\d+_+(?P<race>\d+)", col
-                    ).group("race")
-                    # TODO this needs to be drawn from the JSON
-                    race = race_dict[race_num]
-                    ndar_df.loc[child_id, col_name] = race
-        elif sum > 1:
-            ndar_df.loc[child_id, col_name] = "More than one race"
-        elif sum == 0:
-            ndar_df.loc[child_id, col_name] = "Unknown or not reported"
+    race_labels = get_race_codes(rc_df, race_col_base, race_json)
+    race_df = rc_df[list(race_labels.keys())]
+    if parent:
+        # look up each child's parent row (XX8XXXX) and key it by the child ID
+        race_df = race_df.reindex(remap_ids(ndar_df.index, 8))
+        race_df = race_df.set_axis(ndar_df.index, axis=0)
+    else:
+        race_df = race_df.reindex(ndar_df.index)
+
+    # a row with any missing checkbox sums to NaN and is left unassigned
+    race_sum = race_df.sum(axis=1, skipna=False)
+    one_race = race_sum == 1
+    ndar_df.loc[race_sum > 1, col_name] = "More than one race"
+    ndar_df.loc[race_sum == 0, col_name] = "Unknown or not reported"
+    if one_race.any():
+        race_checked = race_df.loc[one_race].idxmax(axis=1)
+        ndar_df.loc[one_race, col_name] = race_checked.map(race_labels)
 
 
 def map_interview_date(ndar_df, ndar_json, sre, rc, rc_col):
+    """
+    Fill ndar_df's interview_date as datetimes; formatting happens in save_csv.
+    """
     rc_df = redcaps_dict[rc]
-    rc_col = Column(rc_col)
-    rc_variable = rc_col.col
-    rc_variable_es = rc_col.coles
-    for id in rc_df.index:
-        child_id = int(str(id)[0:2] + "0" + str(id)[3:])
-        date_string = rc_df.loc[id, rc_variable]
-        if not isinstance(date_string, str) and isinstance(
-            rc_df.loc[id, rc_variable_es], str
-        ):
-            date_string = rc_df.loc[id, rc_variable_es]
-        if isinstance(date_string, str):
-            date_string = date_string.split(" ")[0]
-            date_obj = datetime.strptime(date_string, "%Y-%m-%d")
-            val = date_obj.strftime("%m/%d/%Y")
-            ndar_df.loc[child_id, "interview_date"] = val
-        else:
-            continue
+    dates = parse_redcap_dates(coalesce_es(rc_df, rc_col))
+    ndar_df["interview_date"] = to_child_rows(dates, ndar_df.index)
+
+
+AGGREGATORS = {}  # "computed" name -> (row-wise reduction, whether to write it as an int)
+
+
+def register_aggregator(name, as_int=False):
+    """
+    Register a row-wise reduction usable as "computed": "<name>" in the JSON.
+
+    The decorated function takes the block of component columns (one row per
+    subject, floats with NaN for missing answers) and the NDAR column's JSON,
+    and returns one value per row, NaN where the value can't be computed
+    (those rows get the column's "missing" value if it has one).
+    """
+
+    def register(func):
+        AGGREGATORS[name] = (func, as_int)
+        return func
+
+    return register
+
+
+@register_aggregator("sum", as_int=True)
+def aggregate_sum(block, col_json):
+    return block.sum(axis=1, skipna=False)
+
+
+@register_aggregator("average")
+def aggregate_average(block, col_json):
+    return block.sum(axis=1, skipna=False) / block.shape[1]
+
+
+@register_aggregator("min", as_int=True)
+def aggregate_min(block, col_json):
+    return block.min(axis=1, skipna=False)
+
+
+@register_aggregator("max", as_int=True)
+def aggregate_max(block, col_json):
+    return block.max(axis=1, skipna=False)
+
+
+@register_aggregator("count", as_int=True)
+def aggregate_count(block, col_json):
+    """Number of components answered."""
+    return block.notna().sum(axis=1)
+
+
+@register_aggregator("prorated_average")
+def aggregate_prorated_average(block, col_json):
+    """Mean of the answered components, if at least "min_answered" were answered."""
+    min_answered = int(col_json.get("min_answered", block.shape[1]))
+    return block.mean(axis=1).where(block.notna().sum(axis=1) >= min_answered)
+
+
+def map_computed(ndar_df, ndar_col, col_json, sre, rc_df, parent=False):
+    """
+    Fill a "computed" NDAR column by reducing its "components" row-wise.
+    """
+    if not isinstance(rc_df, pd.DataFrame):
+        sys.exit(
+            "Can't compute value for " + str(ndar_col)
+            + ", name of redcap missing, exiting."
+        )
+    if "components" not in col_json.keys():
+        sys.exit(
+            "Can't compute value for "
+            + str(ndar_col)
+            + ", must specify components to compute value from, exiting."
+        )
+    if col_json["computed"] not in AGGREGATORS.keys():
+        sys.exit(
+            "Can't compute value for "
+            + str(ndar_col)
+            + ", must specify one of "
+            + ", ".join('"' + name + '"' for name in AGGREGATORS.keys())
+            + ", exiting."
+        )
+    aggregate, as_int = AGGREGATORS[col_json["computed"]]
+
+    comp_cols = [comp + "_" + sre for comp in col_json["components"]]
+    for comp_col in comp_cols:
+        if comp_col not in rc_df.columns:
+            sys.exit(
+                "Can't compute value for "
+                + str(ndar_col)
+                + ", component "
+                + comp_col
+                + " not found in redcap, exiting."
+            )
+    rc_ids = remap_ids(ndar_df.index, 8) if parent else ndar_df.index
+    block = rc_df.reindex(index=rc_ids, columns=comp_cols).astype(float)
+    block = block.set_axis(ndar_df.index, axis=0)
+    values = aggregate(block, col_json)
+
+    computed = values.dropna()
+    if as_int:
+        computed = computed.map(lambda val: str(int(val)))
+    else:
+        computed = computed.map(lambda val: str(float(val)))
+    computed = computed.reindex(ndar_df.index).astype(object)
+    if "missing" in col_json.keys():
+        computed[values.isna()] = col_json["missing"]
+    computed[~rc_ids.isin(rc_df.index)] = ""  # "NA" ?
+    ndar_df.loc[:, ndar_col] = computed
+
+
+def as_codes(values):
+    """
+    Render numeric REDCap codes as strings (1.0 -> "1"), leaving other values as-is.
+    """
+    if pd.api.types.is_numeric_dtype(values) and not pd.api.types.is_bool_dtype(values):
+        return values.dropna().astype(np.int64).astype(str).reindex(values.index)
+    return values.map(
+        lambda val: str(int(val))
+        if isinstance(val, (int, float, np.number)) and not pd.isna(val)
+        else val
+    )
+
+
+def get_conditional_vals(ndar_df, col_json, sre, rc_df, parent=False):
+    """
+    Map an NDAR column's "conditional_column" onto the rows it decides.
+
+    The conditional REDCap may be keyed by child or parent IDs (XX0XXXX,
+    XX8XXXX or XX9XXXX); it's aligned to ndar_df's child IDs in one reindex and
+    its codes are translated with "conditional_column_mapping".
+
+    Returns:
+        pd.Series: Mapped values indexed by child ID, only for rows covered by
+            the mapping; every other row goes through the regular mapping.
+    """
+    conditional_json = col_json["conditional_column"]
+    conditional_rc = conditional_json["redcap"]
+    if "sessionless" in conditional_json.keys():
+        conditional_rc_variable = conditional_json["rc_variable"]
+    else:
+        conditional_rc_variable = conditional_json["rc_variable"] + "_" + sre
+    try:
+        conditional_rc_df = redcaps_dict[conditional_rc]
+    except KeyError:
+        sys.exit("Can't find redcap " + conditional_rc + ", exiting.")
+    if conditional_rc_variable not in conditional_rc_df.columns:
+        sys.exit(
+            "Can't find column " + conditional_rc_variable + " in redcap "
+            + conditional_rc + ", exiting."
+        )
+    if "parent" in conditional_json and conditional_json["parent"].lower() == "true":
+        # look at "es" surveys too if it's a parent survey
+        conditional_vals = coalesce_es(conditional_rc_df, conditional_rc_variable)
+    else:
+        conditional_vals = conditional_rc_df[conditional_rc_variable]
+
+    # conditional redcap could be parent or child, 300's or 308's or 309's
+    conditional_ids = remap_ids(ndar_df.index, str(conditional_rc_df.index[0])[2])
+    conditional_vals = conditional_vals.reindex(conditional_ids).set_axis(ndar_df.index)
+    conditional_vals = as_codes(conditional_vals).map(col_json["conditional_column_mapping"])
+
+    # rows missing from the column's own redcap are left blank by map_vals
+    rc_ids = remap_ids(ndar_df.index, 8) if parent else ndar_df.index
+    return conditional_vals[rc_ids.isin(rc_df.index)].dropna()
 
 
 def map_vals(ndar_df, ndar_col, ndar_csv, ndar_json, sre, parent=False):
@@ -261,6 +577,7 @@ def map_vals(ndar_df, ndar_col, ndar_csv, ndar_json, sre, parent=False):
     )
     # rc_variable = Column(ndar_json[ndar_csv]["req_columns"][ndar_col]["rc_variable"]) if "rc_variable" in ndar_json[ndar_csv]["req_columns"][ndar_col].keys() else math.nan
     rc_df = redcaps_dict[rc] if isinstance(rc, str) else math.nan
+    rc_column = math.nan
     if isinstance(rc_df, pd.core.frame.DataFrame):
         if isinstance(rc_variable, str):
             # if isinstance(rc_variable, Column):
@@ -271,6 +588,23 @@ def map_vals(ndar_df, ndar_col, ndar_csv, ndar_json, sre, parent=False):
         else:
             rc_column = math.nan
 
+    col_json = ndar_json[ndar_csv]["req_columns"][ndar_col]
+    if (
+        not isinstance(rc_variable, str)
+        and "default" not in col_json.keys()
+        and "computed" in col_json.keys()
+    ):
+        map_computed(ndar_df, ndar_col, col_json, sre, rc_df, parent)
+        return
+
+    conditional_vals = pd.Series(dtype=object)
+    if (
+        isinstance(rc_column, str)
+        and "conditional_column" in col_json.keys()
+        and "conditional_column_mapping" in col_json.keys()
+    ):
+        conditional_vals = get_conditional_vals(ndar_df, col_json, sre, rc_df, parent)
+
     for id in ndar_df.index:
         if parent:
             id = int(str(id)[0:2] + "8" + str(id)[3:])  # will IDs always be XX8XXXX?
@@ -291,149 +625,14 @@ def map_vals(ndar_df, ndar_col, ndar_csv, ndar_json, sre, parent=False):
                 val = ndar_json[ndar_csv]["req_columns"][ndar_col]["default"]
                 ndar_df.loc[child_id, ndar_col] = val
                 continue
-            elif "computed" in ndar_json[ndar_csv]["req_columns"][ndar_col].keys():
-                if (
-                    "components"
-                    not in ndar_json[ndar_csv]["req_columns"][ndar_col].keys()
-                ):
-                    sys.exit(
-                        "Can't compute value for "
-                        + str(ndar_col)
-                        + ", must specify components to compute value from, exiting."
-                    )
-                if (
-                    ndar_json[ndar_csv]["req_columns"][ndar_col]["computed"] == "sum"
-                    and "components"
-                    in ndar_json[ndar_csv]["req_columns"][ndar_col].keys()
-                ):
-                    sum = 0
-                    for comp in ndar_json[ndar_csv]["req_columns"][ndar_col][
-                        "components"
-                    ]:
-                        val = float(rc_df.loc[id, comp + "_" + sre])
-                        sum += val
-                    if (
-                        math.isnan(sum)
-                        and "missing"
-                        in ndar_json[ndar_csv]["req_columns"][ndar_col].keys()
-                    ):
-                        ndar_df.loc[child_id, ndar_col] = ndar_json[ndar_csv][
-                            "req_columns"
-                        ][ndar_col]["missing"]
-                    else:
-                        sum = str(int(sum))
-                        ndar_df.loc[child_id, ndar_col] = sum
-                    continue
-                elif (
-                    ndar_json[ndar_csv]["req_columns"][ndar_col]["computed"]
-                    == "average"
-                    and "components"
-                    in ndar_json[ndar_csv]["req_columns"][ndar_col].keys()
-                ):
-                    sum = 0
-                    ncols = len(
-                        ndar_json[ndar_csv]["req_columns"][ndar_col]["components"]
-                    )
-                    for comp in ndar_json[ndar_csv]["req_columns"][ndar_col][
-                        "components"
-                    ]:
-                        val = float(rc_df.loc[id, comp + "_" + sre])
-                        sum += val
-                    if (
-                        math.isnan(sum)
-                        and "missing"
-                        in ndar_json[ndar_csv]["req_columns"][ndar_col].keys()
-                    ):
-                        ndar_df.loc[child_id, ndar_col] = ndar_json[ndar_csv][
-                            "req_columns"
-                        ][ndar_col]["missing"]
-                    else:
-                        avg = str(float(sum / ncols))
-                        ndar_df.loc[child_id, ndar_col] = avg
-                    continue
-                else:
-                    sys.exit(
-                        "Can't compute value for "
-                        + str(ndar_col)
-                        + ', must specify "sum" or "average.", exiting.'
-                    )
             else:
                 sys.exit(
                     "Can't assign value for "
                     + str(ndar_col)
                     + ", name of redcap or redcap variable name missing, exiting."
                 )
-        if (
-            "conditional_column" in ndar_json[ndar_csv]["req_columns"][ndar_col].keys()
-            and "conditional_column_mapping"
-            in ndar_json[ndar_csv]["req_columns"][ndar_col].keys()
-        ):
-            # should really do this and "mapping" in a separate function
-            conditional_rc = ndar_json[ndar_csv]["req_columns"][ndar_col][
-                "conditional_column"
-            ]["redcap"]
-            if (
-                "sessionless"
-                in ndar_json[ndar_csv]["req_columns"][ndar_col][
-                    "conditional_column"
-                ].keys()
-            ):
-                conditional_rc_variable = ndar_json[ndar_csv]["req_columns"][ndar_col][
-                    "conditional_column"
-                ]["rc_variable"]
-            else:
-                conditional_rc_variable = (
-                    ndar_json[ndar_csv]["req_columns"][ndar_col]["conditional_column"][
-                        "rc_variable"
-                    ]
-                    + "_"
-                    + sre
-                )
-            try:
-                conditional_rc_df = redcaps_dict[conditional_rc]
-            except KeyError:
-                sys.exit("Can't find redcap " + conditional_rc + ", exiting.")
-            for col in conditional_rc_df.columns:
-                if col == conditional_rc_variable:
-                    conditional_rc_column = col
-                    if (
-                        "parent"
-                        in ndar_json[ndar_csv]["req_columns"][ndar_col][
-                            "conditional_column"
-                        ]
-                        and ndar_json[ndar_csv]["req_columns"][ndar_col][
-                            "conditional_column"
-                        ]["parent"].lower()
-                        == "true"
-                    ):
-                        conditional_rc_column_es = Column(conditional_rc_column).coles
-                    else:
-                        conditional_rc_column_es = math.nan
-                    break
-            conditional_rc_id = int(
-                str(id)[0:2] + str(conditional_rc_df.index[0])[2] + str(id)[3:]
-            )  # conditional redcap could be parent or child, 300's or 308's or 309's
-            val = conditional_rc_df.loc[conditional_rc_id, conditional_rc_column]
-            if (
-                math.isnan(val)
-                and conditional_rc_column_es in conditional_rc_df.columns
-                and not math.isnan(
-                    conditional_rc_df.loc[conditional_rc_id, conditional_rc_column_es]
-                )
-            ):  # look at "es" surveys too if it's a parent survey
-                val = conditional_rc_df.loc[conditional_rc_id, conditional_rc_column_es]
-            if (isinstance(val, float) or isinstance(val, int)) and not math.isnan(val):
-                val = str(int(val))
-            if (
-                val
-                in ndar_json[ndar_csv]["req_columns"][ndar_col][
-                    "conditional_column_mapping"
-                ].keys()
-            ):
-                ndar_df.loc[child_id, ndar_col] = ndar_json[ndar_csv]["req_columns"][
-                    ndar_col
-                ]["conditional_column_mapping"][val]
-                continue
+        if child_id in conditional_vals.index:
+            continue  # filled in from the conditional column below
         if "mapping" in ndar_json[ndar_csv]["req_columns"][ndar_col].keys():
             val = rc_df.loc[id, rc_column]
             if (
@@ -489,69 +688,248 @@ def map_vals(ndar_df, ndar_col, ndar_csv, ndar_json, sre, parent=False):
                 ndar_df.loc[child_id, ndar_col] = val
             else:
                 ndar_df.loc[child_id, ndar_col] = rc_df.loc[id, rc_column]
+    ndar_df.loc[conditional_vals.index, ndar_col] = conditional_vals
 
 
-def map_adis(
-    ndar_df, ndar_col, ndar_csv, ndar_json, sre, all_columns=False, parent=False
-):
+def map_adis(ndar_df, ndar_csv, ndar_json, sre, all_columns=False, parent=False):
+    """
+    Expand the eight ADIS diagnosis slots into NDAR *_pdx indicator columns.
+
+    Diagnosis codes are translated through the structure's "diagnosis_codes"
+    table. Codes mapped to "None" are ignored, and codes mapped to "sph_pdx"
+    (specific phobia) fill sph_pdxN/phobtypeN in slot order instead.
+    """
     rc_df = redcaps_dict[ndar_json[ndar_csv]["req_columns"]["pd_pdx"]["redcap"]]
-    diagnoses_dict = {
-        "0": "None",
-        "1": "sad_pdx",
-        "2": "sp_pdx",
-        "3": "sph_pdx",
-        "4": "pd_pdx",
-        "5": "pdago_pdx",
-        "6": "agorpdx",
-        "7": "gad_pdx",
-        "8": "ocd_pdx",
-        "9": "ptsdpdx",
-        "10": "mdd_pdx",
-        "12": "adhdpdx",
-        "13": "odd_pdx",
-    }
+    if "diagnosis_codes" not in ndar_json[ndar_csv].keys():
+        sys.exit("Error: no diagnosis_codes table specified for " + ndar_csv + ", exiting.")
+    diagnoses_dict = ndar_json[ndar_csv]["diagnosis_codes"]
     for col in ndar_json[ndar_csv]["req_columns"].keys():
         ndar_df.loc[:, col] = 0
-    for id in ndar_df.index:
-        # for id in list(rc_df.index):
-        diagnoses = []
-        for i in range(1, 9):
-            val = rc_df.loc[id, "adis_fn_dx" + str(i) + "_lb_" + sre]
-            if not math.isnan(val):
-                val = str(int(val))
-                if val not in diagnoses and val != "3":
-                    diagnoses.append(val)
-        for diagnosis in diagnoses:
-            if diagnosis == "0":
-                continue
-            else:
-                col = diagnoses_dict[diagnosis]
-                ndar_df.loc[id, col] = "1"
-        specific_phobias = []
-        for i in range(1, 9):
-            if (
-                not math.isnan(rc_df.loc[id, "adis_fn_dx" + str(i) + "_lb_" + sre])
-                and str(int(rc_df.loc[id, "adis_fn_dx" + str(i) + "_lb_" + sre])) == "3"
-            ):
-                specific_phobias.append(
-                    rc_df.loc[id, "adis_fn_dx" + str(i) + "_sp_" + sre]
-                )
-        for i in range(1, len(specific_phobias) + 1):
-            ndar_df.loc[id, "sph_pdx" + str(i)] = "1"
-            ndar_df.loc[id, "phobtype" + str(i)] = specific_phobias[i - 1]
 
+    slots = list(range(1, 9))
+    dx_cols = ["adis_fn_dx" + str(i) + "_lb_" + sre for i in slots]
+    sp_cols = ["adis_fn_dx" + str(i) + "_sp_" + sre for i in slots]
+    adis_df = rc_df.reindex(index=ndar_df.index, columns=dx_cols + sp_cols)
+
+    # one row per (subject, slot); both melts are slot-major so they line up
+    dx_long = adis_df[dx_cols].set_axis(slots, axis=1).melt(
+        var_name="slot", value_name="code", ignore_index=False
+    )
+    sp_long = adis_df[sp_cols].set_axis(slots, axis=1).melt(
+        var_name="slot", value_name="phobtype", ignore_index=False
+    )
+    dx_long["phobtype"] = sp_long["phobtype"].to_numpy()
+    dx_long = dx_long.rename_axis("id").reset_index().dropna(subset=["code"])
+    dx_long["code"] = pd.to_numeric(dx_long["code"]).astype(int).astype(str)
+    dx_long["pdx"] = dx_long["code"].map(diagnoses_dict)
+    unknown_codes = dx_long.loc[dx_long["pdx"].isna(), "code"].unique()
+    if len(unknown_codes) > 0:
+        sys.exit(
+            "Error: ADIS diagnosis codes " + ", ".join(sorted(unknown_codes))
+            + " not found in diagnosis_codes, exiting."
+        )
+
+    pdx_long = dx_long[~dx_long["pdx"].isin(["None", "sph_pdx"])]
+    pdx_flags = pd.crosstab(pdx_long["id"], pdx_long["pdx"]) > 0
+    for col in pdx_flags.columns:
+        ndar_df.loc[pdx_flags.index[pdx_flags[col]], col] = "1"
+
+    sph_long = dx_long[dx_long["pdx"] == "sph_pdx"].copy()
+    sph_long["n"] = sph_long.groupby("id").cumcount() + 1
+    for n, sph_n in sph_long.groupby("n"):
+        ndar_df.loc[sph_n["id"], "sph_pdx" + str(n)] = "1"
+        ndar_df.loc[sph_n["id"], "phobtype" + str(n)] = sph_n["phobtype"].to_numpy()
+
+
+class HashingWriter:
+    """
+    Text file wrapper that keeps a running SHA-256 of everything written to it.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.sha256 = hashlib.sha256()
 
-def save_csv(ndar_csv, ndar_df):
-    ndar_df.to_csv("tmpfile.csv", index=False)
-    f = open("tmpfile.csv", "r")
-    csvstring = f.read()
-    f.close()
-    with open(
-        os.path.join(out_path, ndar_csv + "_" + sre + "_incomplete.csv"), "w"
-    ) as f:
-        f.write(ndar_csv[0:-2] + ",01" + "," * (len(df.columns) - 2) + "\n")
-        f.write(csvstring)
-    os.remove("tmpfile.csv")
+    def write(self, text):
+        self.sha256.update(text.encode("utf-8"))
+        return self.f.write(text)
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def write_ndar_csv(out_file, ndar_csv, ndar_df, chunksize=CSV_CHUNKSIZE):
+    """
+    Write an NDAR CSV (the "<structure>,01" line, then the column header and rows).
+
+    Rows are streamed in chunks into a temp file next to out_file, which is
+    then renamed into place, so concurrent runs never share a scratch file and
+    a failed run never leaves a half-written CSV behind. If out_file already
+    holds exactly the same content it is left untouched.
+
+    Returns:
+        bool: True if out_file was (re)written, False if it was unchanged.
+    """
+    out_dir = os.path.dirname(os.path.abspath(out_file))
+    fd, tmp_file = tempfile.mkstemp(
+        dir=out_dir, prefix="." + os.path.basename(out_file) + ".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "w", newline="") as f:
+            writer = HashingWriter(f)
+            writer.write(ndar_csv[0:-2] + ",01" + "," * (len(ndar_df.columns) - 2) + "\n")
+            ndar_df.to_csv(
+                writer, index=False, date_format="%m/%d/%Y", chunksize=chunksize
+            )
+        if os.path.isfile(out_file) and file_sha256(out_file) == writer.hexdigest():
+            os.remove(tmp_file)
+            return False
+        # mkstemp creates the file as 0600; give it the usual permissions
+        if os.path.isfile(out_file):
+            mode = stat.S_IMODE(os.stat(out_file).st_mode)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            mode = 0o666 & ~umask
+        os.chmod(tmp_file, mode)
+        os.replace(tmp_file, out_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    return True
+
+
+def save_csv(ndar_csv, ndar_df, out_path, sre):
+    out_file = os.path.join(out_path, ndar_csv + "_" + sre + "_incomplete.csv")
+    if not write_ndar_csv(out_file, ndar_csv, ndar_df):
+        print(f"{out_file} is unchanged, skipping write.")
+
+
+def row_hashes(ndar_df):
+    """
+    SHA-256 of each row of ndar_df, as the row is written to the NDAR CSV.
+    """
+    rows = ndar_df.to_csv(index=False, header=False, date_format="%m/%d/%Y")
+    return pd.Series(
+        [
+            hashlib.sha256("\x1f".join(record).encode("utf-8")).hexdigest()
+            for record in csv.reader(io.StringIO(rows))
+        ],
+        index=ndar_df.index,
+        dtype=object,
+    )
+
+
+def read_ledger(ledger_file):
+    """
+    Read a structure's ledger as a row_hash Series indexed by (src_subject_id, sre).
+    """
+    if not os.path.isfile(ledger_file):
+        return pd.Series(
+            dtype=object,
+            index=pd.MultiIndex.from_arrays([[], []], names=["src_subject_id", "sre"]),
+            name="row_hash",
+        )
+    ledger = pd.read_csv(ledger_file, dtype=str, index_col=["src_subject_id", "sre"])
+    return ledger["row_hash"]
+
+
+def write_ledger(ledger_file, ledger):
+    fd, tmp_file = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(ledger_file)), suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, "w", newline="") as f:
+            ledger.to_csv(f)
+        os.replace(tmp_file, ledger_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+
+
+def save_delta(ndar_csv, ndar_df, out_path, sre, ledger_dir):
+    """
+    Incremental mode: write only the rows that are new or changed since the last submission.
+
+    Each structure has a ledger (<ledger_dir>/<structure>_ledger.csv) of the
+    rows already submitted, keyed by (src_subject_id, sre) with the SHA-256 of
+    the row. Rows whose key isn't in the ledger, or whose hash differs, are
+    written to <structure>_<sre>_delta.csv and their hashes to
+    <ledger_dir>/<structure>_<sre>_pending.csv; the rest are skipped.
+
+    The ledger itself is only updated by confirm_ledger, once the delta has
+    been uploaded, so rerunning before then writes the same rows again.
+
+    Returns:
+        dict[str, int]: Number of "new", "changed" and "unchanged" rows.
+    """
+    os.makedirs(ledger_dir, exist_ok=True)
+    ledger_file = os.path.join(ledger_dir, ndar_csv + "_ledger.csv")
+    hashes = row_hashes(ndar_df)
+    keys = pd.MultiIndex.from_arrays(
+        [ndar_df["src_subject_id"].astype(str), [sre] * len(ndar_df)],
+        names=["src_subject_id", "sre"],
+    )
+    ledger = read_ledger(ledger_file)  # replaced atomically, no lock needed to read
+    prev_hashes = pd.Series(ledger.reindex(keys).to_numpy(), index=ndar_df.index)
+    new_rows = prev_hashes.isna()
+    changed_rows = ~new_rows & (prev_hashes != hashes)
+
+    delta_rows = (new_rows | changed_rows).to_numpy()
+    delta_file = os.path.join(out_path, ndar_csv + "_" + sre + "_delta.csv")
+    write_ndar_csv(delta_file, ndar_csv, ndar_df[delta_rows])
+    pending = pd.Series(hashes.to_numpy(), index=keys, name="row_hash")[delta_rows]
+    write_ledger(os.path.join(ledger_dir, ndar_csv + "_" + sre + PENDING_SUFFIX), pending)
+
+    counts = {
+        "new": int(new_rows.sum()),
+        "changed": int(changed_rows.sum()),
+        "unchanged": int(len(ndar_df) - delta_rows.sum()),
+    }
+    print(
+        f"{delta_file}: {counts['new']} new, {counts['changed']} changed, "
+        f"skipped {counts['unchanged']} unchanged row(s); run --confirm-ledger "
+        f"{ledger_dir} once it's uploaded."
+    )
+    return counts
+
+
+def confirm_ledger(ledger_dir):
+    """
+    Record every pending delta in ledger_dir as submitted.
+
+    Run this once the deltas written by save_delta have been uploaded: each
+    <structure>_<sre>_pending.csv is merged into <structure>_ledger.csv and
+    removed, so those rows are left out of the next delta.
+    """
+    pending_re = re.compile(r"(?P<structure>.+)_(?P<sre>s\d+_r\d+_e\d+)" + re.escape(PENDING_SUFFIX))
+    pending_files = sorted(
+        file for file in os.listdir(ledger_dir) if pending_re.fullmatch(file)
+    )
+    if not pending_files:
+        print(f"No pending deltas in {ledger_dir}.")
+    for file in pending_files:
+        structure = pending_re.fullmatch(file).group("structure")
+        pending_file = os.path.join(ledger_dir, file)
+        ledger_file = os.path.join(ledger_dir, structure + "_ledger.csv")
+        with open(ledger_file + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            pending = read_ledger(pending_file)
+            ledger = read_ledger(ledger_file)
+            ledger = pd.concat([ledger[~ledger.index.isin(pending.index)], pending])
+            write_ledger(ledger_file, ledger)
+            os.remove(pending_file)
+        print(f"Recorded {len(pending)} row(s) from {file} in {ledger_file}.")
 
 
 class Column:
@@ -622,10 +1000,12 @@ def get_redcaps_from_other_sessions(ndar_json: dict) -> list[str]:
                 other_redcaps.append(different_session_redcap)
     other_redcaps = list(set(other_redcaps))
     return other_redcaps
-def get_other_session_redcaps(redcap_dir: str, ndar_json: dict, redcaps_dict: dict) -> list[str]:
+def get_other_session_redcaps(
+    redcap_dir: str, ndar_json: dict, redcaps_dict: dict, needed_columns: dict
+) -> dict:
     """
-    Get the REDCaps that are relevant to other sessions.    
-    Returns a list of full paths to REDCap files.
+    Add the REDCaps that are relevant to other sessions to redcaps_dict.
+    Returns redcaps_dict.
     """
     all_redcaps = get_new_redcaps(redcap_dir)
     # only take in from checked dir
@@ -637,24 +1017,185 @@ def get_other_session_redcaps(redcap_dir: str, ndar_json: dict, redcaps_dict: di
     if len(other_redcaps) == 0:
         return redcaps_dict
     for expected_rc in other_expected_rcs:
-        present = False
-        for redcap in other_redcaps:
-            if expected_rc in os.path.basename(redcap.lower()):
-                present = True
-                prev_df = redcaps_dict.get(expected_rc, pd.DataFrame())
-                new_df = pd.read_csv(redcap, index_col="record_id")
-                redcaps_dict[expected_rc] = pd.concat([prev_df, new_df])
-                
-        if not present:
+        matching_redcaps = [
+            redcap
+            for redcap in other_redcaps
+            if expected_rc in os.path.basename(redcap.lower())
+        ]
+        if not matching_redcaps:
             sys.exit(
                 "Error: can't find redcap specified in datadict "
                 + expected_rc
                 + ", exiting."
             )
+        rc_dfs = read_redcap_columns(matching_redcaps, needed_columns[expected_rc])
+        if expected_rc in redcaps_dict.keys():
+            rc_dfs.insert(0, ("", redcaps_dict[expected_rc]))  # already merged, oldest
+        redcaps_dict[expected_rc] = coalesce_records(rc_dfs, expected_rc)
     return redcaps_dict
 
 
+def map_all_columns():
+    """
+    Map the columns every structure shares ("all") once, into a base frame.
+    """
+    base_df = pd.DataFrame(columns=list(ndar_json["all"]["req_columns"].keys()), index=ids)
+    for col in ndar_json["all"]["req_columns"].keys():
+        if col == "interview_date":
+            rc = ndar_json["all"]["req_columns"]["interview_date"]["redcap"]
+            rc_col = ndar_json["all"]["req_columns"]["interview_date"]["rc_variable"]
+            map_interview_date(base_df, ndar_json, sre, rc, rc_col)
+            continue
+        if col == "interview_age":
+            ndar_json_date = ndar_json["all"]["req_columns"]["interview_age"]
+            if "child_variable" in ndar_json_date.keys():
+                child_variable_json = ndar_json_date["child_variable"]
+                map_interview_age(base_df,redcaps_dict, ndar_json_date,child_variable_json)
+            else:
+                map_interview_age(base_df,redcaps_dict, ndar_json_date)
+
+            continue
+        if col == "src_subject_id":
+            base_df.loc[:, col] = ids
+            continue
+        parent_col = False
+        if (
+            "parent" in ndar_json["all"]["req_columns"][col]
+            and ndar_json["all"]["req_columns"][col]["parent"].lower() == "true"
+        ):
+            parent_col = True
+        map_vals(base_df, col, "all", ndar_json, sre, parent=parent_col)
+    return base_df
+
+
+def gen_ndar_csv(ndar_csv):
+    """
+    Generate and save one NDAR structure, returning how long it took.
+
+    Runs in worker processes set up by init_worker, which memory-maps the
+    REDCap frames and base_df from Arrow files instead of unpickling copies.
+    """
+    start = time.perf_counter()
+    print(f"Generating {ndar_csv} for {sre}...")
+    ndar_columns = ndar_json[ndar_csv]["all_columns"]
+    df = pd.DataFrame(columns=ndar_columns, index=ids)
+    if ndar_csv == "adis_v01":
+        map_adis(df, ndar_csv, ndar_json, sre)
+    for col in base_df.columns:
+        df[col] = base_df[col]
+    for col in ndar_json[ndar_csv]["req_columns"]:
+        if (
+            col in ndar_json["all"]["req_columns"].keys()
+        ):  # already mapped columns in all ^^
+            continue
+        if col == "race":
+            race_redcap = ndar_json[ndar_csv]["req_columns"][col]["redcap"]
+            race_column = ndar_json[ndar_csv]["req_columns"][col]["rc_variable"]
+            sessionless = (
+                True
+                if "sessionless" in ndar_json[ndar_csv]["req_columns"][col].keys()
+                else False
+            )
+            parent = (
+                True
+                if "parent" in ndar_json[ndar_csv]["req_columns"][col].keys()
+                else False
+            )
+            map_race(
+                df,
+                ndar_json[ndar_csv]["req_columns"][col],
+                race_redcap,
+                race_column,
+                sre,
+                col,
+                sessionless=sessionless,
+                parent=parent,
+            )
+            continue
+        if col == "timepoint_label":
+            sess = sre[0:2]
+            df.loc[:, col] = sess
+            continue
+        if (
+            "mapping" in ndar_json[ndar_csv]["req_columns"][col].keys()
+            and ndar_json[ndar_csv]["req_columns"][col]["mapping"] == "custom"
+        ):
+            continue  # "custom" mappings should be done by here
+        parent_col = False
+        if (
+            "parent" in ndar_json[ndar_csv]["req_columns"][col]
+            and ndar_json[ndar_csv]["req_columns"][col]["parent"].lower() == "true"
+        ):
+            parent_col = True
+        map_vals(df, col, ndar_csv, ndar_json, sre, parent=parent_col)
+    save_csv(ndar_csv, df, out_path, sre)
+    if ledger_dir is not None:
+        save_delta(ndar_csv, df, out_path, sre, ledger_dir)
+    print(f"Finished {ndar_csv}.\n")
+    return time.perf_counter() - start
+
+
+def share_frame(df, share_dir, name):
+    """
+    Write a frame to <share_dir>/<name>.arrow for workers to memory-map.
+
+    Returns the file's path, or the frame itself when pyarrow isn't installed
+    or the frame can't be converted (it's then pickled to each worker).
+    """
+    if pa is None:
+        return df
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=True)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        return df  # e.g. a column mixing numbers and strings
+    path = os.path.join(share_dir, name + ".arrow")
+    with pa.OSFile(path, "wb") as f:
+        with ipc.new_file(f, table.schema) as writer:
+            writer.write_table(table)
+    return path
+
+
+def load_shared_frame(shared):
+    """Read a frame written by share_frame (or passed as-is)."""
+    if isinstance(shared, pd.DataFrame):
+        return shared
+    return ipc.open_file(pa.memory_map(shared, "r")).read_all().to_pandas(split_blocks=True)
+
+
+def init_worker(state, shared_redcaps, shared_base_df):
+    """
+    Set up a spawned worker with the globals gen_ndar_csv reads.
+
+    Workers are spawned rather than forked: by the time the pool starts, the
+    parent has pyarrow's and pandas' threads running, and forking a process
+    with live threads can deadlock the child. The REDCap frames and base_df
+    are memory-mapped from the Arrow files share_frame wrote, rather than
+    pickled to every worker.
+    """
+    globals().update(state)
+    globals()["redcaps_dict"] = {
+        rc: load_shared_frame(shared) for rc, shared in shared_redcaps.items()
+    }
+    globals()["base_df"] = load_shared_frame(shared_base_df)
+
+
+def get_num_workers():
+    """CPUs this process may run on (respects SLURM/cgroup CPU affinity)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS
+        return os.cpu_count() or 1
+
+
 if __name__ == "__main__":
+    if "--confirm-ledger" in sys.argv:  # after uploading the deltas, see confirm_ledger
+        confirm_ledger(sys.argv[sys.argv.index("--confirm-ledger") + 1])
+        sys.exit(0)
+    ledger_dir = None
+    if "--ledger" in sys.argv:  # incremental mode, see save_delta
+        ledger_idx = sys.argv.index("--ledger")
+        ledger_dir = sys.argv[ledger_idx + 1]
+        del sys.argv[ledger_idx : ledger_idx + 2]
     redcap_dir = sys.argv[
         1
     ]  # path to the top-level directory that contains the dataset's REDCaps
@@ -675,8 +1216,12 @@ if __name__ == "__main__":
     with open(ndar_json, "r") as json_file:
         ndar_json = json.load(json_file)
 
-    redcaps_dict = get_redcaps(df_dd, redcaps, ndar_json)  # dataframes of each redcap
-    redcaps_dict = get_other_session_redcaps(redcap_dir, ndar_json, redcaps_dict) # dataframes of each redcap including other sessions
+    # only the REDCap columns the mapping reads are loaded
+    needed_columns = get_needed_columns(ndar_json, sre)
+    redcaps_dict = get_redcaps(df_dd, redcaps, needed_columns)  # dataframes of each redcap
+    redcaps_dict = get_other_session_redcaps(
+        redcap_dir, ndar_json, redcaps_dict, needed_columns
+    )  # dataframes of each redcap including other sessions
 
 
     if (
@@ -707,87 +1252,45 @@ if __name__ == "__main__":
         ids = [
             int(str(id)[0:2] + "0" + str(id)[3:]) for id in complete_infosht_ids
         ]  # quick fix to parent ids -> child ids
-    for ndar_csv in ndar_json.keys():
-        if ndar_csv == "all":
-            continue
-        print(f"Generating {ndar_csv} for {sre}...")
-        ndar_columns = ndar_json[ndar_csv]["all_columns"]
-        df = pd.DataFrame(columns=ndar_columns, index=ids)
-        if ndar_csv == "adis_v01":
-            map_adis(df, col, ndar_csv, ndar_json, sre)
-        for col in ndar_json["all"]["req_columns"].keys():
-            if col == "interview_date":
-                rc = ndar_json["all"]["req_columns"]["interview_date"]["redcap"]
-                rc_col = ndar_json["all"]["req_columns"]["interview_date"]["rc_variable"]
-                map_interview_date(df, ndar_json, sre, rc, rc_col)
-                continue
-            if col == "interview_age":
-                ndar_json_date = ndar_json["all"]["req_columns"]["interview_age"]
-                date_rc = ndar_json_date["redcap"]
-                date_rc_col = ndar_json_date["rc_variable"]
-                if "child_variable" in ndar_json_date.keys():
-                    child_variable_json = ndar_json_date["child_variable"]
-                    child_rc = child_variable_json["redcap"]
-                    child_rc_col = child_variable_json["rc_variable"]
-                    map_interview_age(df,redcaps_dict, ndar_json_date,child_variable_json)
-                else:
-                    map_interview_age(df,redcaps_dict, ndar_json_date)
+    start = time.perf_counter()
+    base_df = map_all_columns()
+    timings = {"all": time.perf_counter() - start}
 
-                continue
-            if col == "src_subject_id":
-                df.loc[:, col] = ids
-                continue
-            parent_col = False
-            if (
-                "parent" in ndar_json["all"]["req_columns"][col]
-                and ndar_json["all"]["req_columns"][col]["parent"].lower() == "true"
-            ):
-                parent_col = True
-            map_vals(df, col, "all", ndar_json, sre, parent=parent_col)
-        for col in ndar_json[ndar_csv]["req_columns"]:
-            if (
-                col in ndar_json["all"]["req_columns"].keys()
-            ):  # already mapped columns in all ^^
-                continue
-            if col == "race":
-                race_redcap = ndar_json[ndar_csv]["req_columns"][col]["redcap"]
-                race_column = ndar_json[ndar_csv]["req_columns"][col]["rc_variable"]
-                sessionless = (
-                    True
-                    if "sessionless" in ndar_json[ndar_csv]["req_columns"][col].keys()
-                    else False
-                )
-                parent = (
-                    True
-                    if "parent" in ndar_json[ndar_csv]["req_columns"][col].keys()
-                    else False
-                )
-                map_race(
-                    df,
-                    ndar_json,
-                    race_redcap,
-                    race_column,
-                    sre,
-                    col,
-                    sessionless=sessionless,
-                    parent=parent,
-                )
-                continue
-            if col == "timepoint_label":
-                sess = sre[0:2]
-                df.loc[:, col] = sess
-                continue
-            if (
-                "mapping" in ndar_json[ndar_csv]["req_columns"][col].keys()
-                and ndar_json[ndar_csv]["req_columns"][col]["mapping"] == "custom"
-            ):
-                continue  # "custom" mappings should be done by here
-            parent_col = False
-            if (
-                "parent" in ndar_json[ndar_csv]["req_columns"][col]
-                and ndar_json[ndar_csv]["req_columns"][col]["parent"].lower() == "true"
-            ):
-                parent_col = True
-            map_vals(df, col, ndar_csv, ndar_json, sre, parent=parent_col)
-        save_csv(ndar_csv, df)
-        print(f"Finished {ndar_csv}.\n")
+    ndar_csvs = [ndar_csv for ndar_csv in ndar_json.keys() if ndar_csv != "all"]
+    num_workers = min(get_num_workers(), len(ndar_csvs))
+    if num_workers <= 1:
+        for ndar_csv in ndar_csvs:
+            timings[ndar_csv] = gen_ndar_csv(ndar_csv)
+    else:
+        worker_state = {
+            "ndar_json": ndar_json,
+            "sre": sre,
+            "ids": ids,
+            "out_path": out_path,
+            "ledger_dir": ledger_dir,
+        }
+        share_dir = tempfile.mkdtemp(prefix="gen_ndar_")
+        try:
+            shared_redcaps = {
+                rc: share_frame(rc_df, share_dir, "redcap_" + str(i))
+                for i, (rc, rc_df) in enumerate(redcaps_dict.items())
+            }
+            shared_base_df = share_frame(base_df, share_dir, "base_df")
+            with ProcessPoolExecutor(
+                max_workers=num_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker,
+                initargs=(worker_state, shared_redcaps, shared_base_df),
+            ) as executor:
+                futures = {
+                    ndar_csv: executor.submit(gen_ndar_csv, ndar_csv) for ndar_csv in ndar_csvs
+                }
+                for ndar_csv, future in futures.items():
+                    timings[ndar_csv] = future.result()
+        finally:
+            shutil.rmtree(share_dir, ignore_errors=True)
+
+    print(f"Timings for {sre} ({num_workers} worker(s)):")
+    for name, elapsed in timings.items():
+        print(f"  {name:<25} {elapsed:8.2f}s")
+    print(f"  {'total':<25} {time.perf_counter() - start:8.2f}s")
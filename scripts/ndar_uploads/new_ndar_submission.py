@@ -1,73 +1,203 @@
+import csv
+import errno
 import os
-from os.path import basename, join, isdir
+from os.path import join, isdir
+import shutil
 import sys
 import re
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+### stages the EEG of every (subject, session) not submitted to NDAR yet into <submission>/eeg and writes
+### <submission>/eeg_sub_files01.csv for them
+###
+### the .zip packages of prior submission folders are kept in data-monitoring/ndar/eeg_submission_index.csv,
+### with the mtime of each folder's eeg/, so a prior folder is only listed again when its eeg/ changes (e.g.
+### more zips were added); entries of folders that have been removed since are dropped, and the current
+### submission is never indexed
+###
+### USAGE: python3 new_ndar_submission.py <dataset> <current submission>
+
+INDEX_FILE = "eeg_submission_index.csv"
+INDEX_COLUMNS = ["package", "src_subject_id", "session", "submission", "eeg_mtime_ns"]
+PACKAGE_RE = r"(sub-\d+)_[\w\-]+_(s\d+_r\d+)_e\d+\.zip"
+STAGING_THREADS = 8  # packages staged at once
+
+
+def read_index(ndar_dir):
+    """
+    Read the index of submitted EEG packages, as a list of dicts (INDEX_COLUMNS).
+    """
+    index_file = join(ndar_dir, INDEX_FILE)
+    if not os.path.isfile(index_file):
+        return []
+    with open(index_file, "r", newline="") as f:
+        return list(csv.DictReader(f))
+
+
+def write_index(ndar_dir, index):
+    index_file = join(ndar_dir, INDEX_FILE)
+    with open(index_file + ".tmp", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=INDEX_COLUMNS)
+        writer.writeheader()
+        writer.writerows(index)
+    os.replace(index_file + ".tmp", index_file)
+
+
+def index_prior_submissions(ndar_dir, current_submission, index):
+    """
+    Bring the index in line with the prior submission folders.
+
+    Entries of the current submission, or of folders that no longer exist
+    (e.g. an abandoned submission that was deleted), are dropped. Then only
+    the submission folders whose eeg/ isn't indexed with its current mtime
+    (never seen, or changed since, e.g. zips were added) are listed again.
+    """
+    removed = set(
+        dir for dir in set(row["submission"] for row in index) if not isdir(join(ndar_dir, dir))
+    )
+    for dir in sorted(removed):
+        print("dropping removed submission " + dir + " from the index")
+    index = [
+        row
+        for row in index
+        if row["submission"] != current_submission and row["submission"] not in removed
+    ]
+    indexed = dict((row["submission"], row.get("eeg_mtime_ns")) for row in index)
+    for dir in sorted(os.listdir(ndar_dir)):
+        if dir == current_submission or not isdir(join(ndar_dir, dir)):
+            continue
+        eeg_dir = join(ndar_dir, dir, "eeg")
+        eeg_mtime_ns = str(os.stat(eeg_dir).st_mtime_ns) if isdir(eeg_dir) else None
+        if indexed.get(dir) == eeg_mtime_ns:
+            continue
+        if dir in indexed:
+            index = [row for row in index if row["submission"] != dir]
+        if eeg_mtime_ns is None:
+            continue
+        print("indexing prior submission " + dir)
+        for file in sorted(os.listdir(eeg_dir)):
+            file_re = re.match(PACKAGE_RE, file)
+            if file_re:
+                index.append(
+                    {
+                        "package": file,
+                        "src_subject_id": file_re.group(1),
+                        "session": file_re.group(2),
+                        "submission": dir,
+                        "eeg_mtime_ns": eeg_mtime_ns,
+                    }
+                )
+    return index
+
+
+def get_current_packages(checked_dir):
+    """
+    Find every (subject, session) with EEG data, listing each eeg folder once.
+
+    Returns:
+        list[str]: Package names like "sub-3000001_all_eeg_s1_r1_e1.zip".
+    """
+    packages = []
+    for sub_folder in os.listdir(checked_dir):
+        if not sub_folder.startswith("sub-"):
+            continue
+        for sess_folder in os.listdir(join(checked_dir, sub_folder)):
+            eeg_dir = join(checked_dir, sub_folder, sess_folder, "eeg")
+            if not isdir(eeg_dir):
+                continue
+            eeg_files = os.listdir(eeg_dir)
+            if len(eeg_files) > 0 and "no-data.txt" not in eeg_files:
+                packages.append(sub_folder + "_all_eeg_" + sess_folder + "_e1.zip")
+    return packages
+
+
+def link_or_copy(src, dest):
+    """
+    Hardlink src to dest, copying instead where the filesystem can't link.
+    """
+    try:
+        os.link(src, dest)
+    except OSError as e:
+        if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP]:
+            raise
+        shutil.copy2(src, dest)
+
+
+def stage_package(src_dir, dest_dir):
+    """
+    Stage a subject's eeg folder as dest_dir, via a temp folder so a failed
+    run never leaves a partial package behind.
+    """
+    if isdir(dest_dir):
+        return False
+    tmp_dir = dest_dir + ".tmp"
+    if isdir(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    shutil.copytree(src_dir, tmp_dir, copy_function=link_or_copy)
+    os.rename(tmp_dir, dest_dir)
+    return True
+
 
 if __name__ == "__main__":
     dataset = sys.argv[1]
     current_submission = sys.argv[2]
     dataset = '/home/data/NDClab/datasets/' + dataset
+    ndar_dir = join(dataset, 'data-monitoring', 'ndar')
     print("starting")
-    if not isdir(join(dataset,'data-monitoring','ndar',current_submission)):
+    if not isdir(join(ndar_dir,current_submission)):
         sys.exit("Error, current submission folder doesn't exist")
-    if not isdir(join(dataset,'data-monitoring','ndar',current_submission,'eeg')):
-        os.mkdir(join(dataset,'data-monitoring','ndar',current_submission,'eeg'))
-    prior_submissions = []
-    for dir in os.listdir(join(dataset,'data-monitoring','ndar')):
-        if dir != current_submission and isdir(join(dataset,'data-monitoring','ndar',dir)):
-            prior_submissions.append(join(dataset,'data-monitoring','ndar',dir))
-    if len(prior_submissions) == 0:
-        #sys.exit("Error, no prior_submission directories seen in ndar folder")
+    if not isdir(join(ndar_dir,current_submission,'eeg')):
+        os.mkdir(join(ndar_dir,current_submission,'eeg'))
+
+    index = index_prior_submissions(ndar_dir, current_submission, read_index(ndar_dir))
+    write_index(ndar_dir, index)
+    if len(index) == 0:
         print("first submission")
-    prior_sub_files = []
-    for prior_submission in prior_submissions:
-        for file in os.listdir(join(prior_submission,'eeg')):
-            if re.match(r'(sub-\d+)_[\w\-]+_(s\d+_r\d+)_e\d+\.zip', file):
-                prior_sub_files.append(file)
-    current_sub_files = []
-    for sub_folder in os.listdir(join(dataset,'sourcedata','checked')):
-        if sub_folder.startswith('sub-'):
-            for sess_folder in os.listdir(join(dataset,'sourcedata','checked',sub_folder)):
-                if isdir(join(dataset,'sourcedata','checked',sub_folder,sess_folder,'eeg')):
-                    if len(os.listdir(join(dataset,'sourcedata','checked',sub_folder,sess_folder,'eeg'))) > 0:
-                        if 'no-data.txt' not in os.listdir(join(dataset,'sourcedata','checked',sub_folder,sess_folder,'eeg')):
-                            current_sub_files.append(sub_folder+'_all_eeg_'+sess_folder+'_e1.zip')
-    new_sub_files = set(current_sub_files).difference(set(prior_sub_files))
+    prior_sub_files = set(row["package"] for row in index)
+
+    current_sub_files = get_current_packages(join(dataset, 'sourcedata', 'checked'))
+    new_sub_files = set(current_sub_files).difference(prior_sub_files)
     if len(new_sub_files) == 0:
         sys.exit("Exiting, no new subjects seen")
-    else:
-        file_by_session = defaultdict(list)
-        for file in new_sub_files:
-            file_re = re.match('(sub-\d+)_[a-zA-Z0-9_-]+_(s\d+)_r\d+_e\d+\.zip', file)
-            if file_re:
-                sess = file_re.group(2)
-                file_by_session[sess].append(file)
-        new_sub_files = []
-        sessions = list(file_by_session.keys())
-        sessions.sort()
-        for sess in sessions:
-            file_by_session[sess].sort()
-            new_sub_files.extend(file_by_session[sess])
-    for new_sub_file in new_sub_files:
-        file_re = re.match(r'(sub-\d+)_[\w\-]+_(s\d+_r\d+)_e\d+\.zip', new_sub_file)
+    file_by_session = defaultdict(list)
+    for file in new_sub_files:
+        file_re = re.match(r'(sub-\d+)_[a-zA-Z0-9_-]+_(s\d+)_r\d+_e\d+\.zip', file)
         if file_re:
+            sess = file_re.group(2)
+            file_by_session[sess].append(file)
+    new_sub_files = []
+    for sess in sorted(file_by_session.keys()):
+        new_sub_files.extend(sorted(file_by_session[sess]))
+
+    # hardlink (or copy) each package's files, several packages at a time
+    with ThreadPoolExecutor(max_workers=STAGING_THREADS) as executor:
+        futures = {}
+        for new_sub_file in new_sub_files:
+            file_re = re.match(PACKAGE_RE, new_sub_file)
+            if not file_re:
+                continue
             sub_folder = file_re.group(1)
             sess_folder = file_re.group(2)
-            if 'no-data.txt' not in os.listdir(join(dataset,'sourcedata','checked',sub_folder,sess_folder,'eeg')):
-                if not isdir(join(dataset,'data-monitoring','ndar',current_submission,'eeg',sub_folder+'_all_eeg_'+sess_folder+'_e1')):
-                    os.system('cp -R ' + join(dataset,'sourcedata','checked',sub_folder,sess_folder,'eeg') + ' ' + \
-                                join(dataset,'data-monitoring','ndar',current_submission,'eeg',sub_folder+'_all_eeg_'+sess_folder+'_e1'))
+            futures[new_sub_file] = executor.submit(
+                stage_package,
+                join(dataset, 'sourcedata', 'checked', sub_folder, sess_folder, 'eeg'),
+                join(ndar_dir, current_submission, 'eeg', sub_folder+'_all_eeg_'+sess_folder+'_e1'),
+            )
+        for new_sub_file, future in futures.items():
+            if future.result():
+                print("staged " + new_sub_file)
+
     #experiment_id = "2232" # thrive = 2232
     experiment_id = "" # read leave blank
-    with open(join(dataset,'data-monitoring','ndar',current_submission,'eeg_sub_files01.csv'), 'w') as f:
+    with open(join(ndar_dir,current_submission,'eeg_sub_files01.csv'), 'w') as f:
         f.write('eeg_sub_files,01,,,,,,,\n')
         f.write('subjectkey,src_subject_id,interview_date,interview_age,sex,experiment_id,data_file1,data_file1_type,timepoint_label\n')
         for new_sub_file in new_sub_files:
-            file_re = re.match(r'sub-(\d+)_[\w\-]+_(s\d+)_r\d+_e\d+\.zip', new_sub_file)
-            if file_re:
-                src_subject_id = file_re.group(1)
-                timepoint_label = file_re.group(2)
-                f.write(','+src_subject_id+',,,,'+experiment_id+','+new_sub_file+',file folder,'+timepoint_label+'\n')
-            else:
-                print("doesn't match expected format?")
+            file_re = re.match(PACKAGE_RE, new_sub_file)
+            if not file_re:
+                print("doesn't match expected format? " + new_sub_file)
+                continue
+            src_subject_id = file_re.group(1)[len("sub-"):]
+            timepoint_label = file_re.group(2).split("_")[0]
+            f.write(','+src_subject_id+',,,,'+experiment_id+','+new_sub_file+',file folder,'+timepoint_label+'\n')
@@ -3,12 +3,74 @@ import sys
 from os.path import join
 import os
 
+DEMOGRAPHIC_COLUMNS = ["interview_date", "interview_age", "sex"]
+MATCH_KEYS = ["timepoint_label", "src_subject_id"]
+
+
+def backfill_demographics(eeg_df, redcap_dfs):
+    """
+    Fill eeg_df's interview_date, interview_age and sex from the REDCap NDAR CSVs.
+
+    All sessions' rows are joined to eeg_df in one merge on (timepoint_label,
+    src_subject_id). A subject listed more than once for a session is
+    ambiguous and isn't filled.
+
+    Args:
+        eeg_df (pd.DataFrame): EEG submission rows, updated in place.
+        redcap_dfs (dict[str, pd.DataFrame]): Session (e.g. "s1") -> NDAR CSV.
+
+    Returns:
+        tuple[pd.Index, pd.Index]: Labels of the eeg_df rows that didn't
+            match any subject and of those that matched ambiguously.
+    """
+    ref_df = pd.concat(
+        [
+            redcap_df[["src_subject_id"] + DEMOGRAPHIC_COLUMNS].assign(timepoint_label=ses)
+            for ses, redcap_df in redcap_dfs.items()
+        ],
+        ignore_index=True,
+    )
+    ref_df["src_subject_id"] = pd.to_numeric(
+        ref_df["src_subject_id"], errors="coerce"
+    ).astype(float)
+    duplicated = ref_df.duplicated(subset=MATCH_KEYS, keep=False)
+    ambiguous_keys = ref_df.loc[duplicated, MATCH_KEYS].drop_duplicates()
+    ref_df = ref_df[~duplicated]
+
+    eeg_keys = pd.DataFrame(
+        {
+            "timepoint_label": eeg_df["timepoint_label"].to_numpy(),
+            "src_subject_id": pd.to_numeric(eeg_df["src_subject_id"], errors="coerce")
+            .astype(float)
+            .to_numpy(),
+        }
+    )
+    matched = eeg_keys.merge(ref_df, on=MATCH_KEYS, how="left", indicator=True)
+    matched.index = eeg_df.index
+    is_matched = matched["_merge"] == "both"
+    for col in DEMOGRAPHIC_COLUMNS:
+        eeg_df[col] = matched[col].where(is_matched, eeg_df[col])
+    ages = pd.to_numeric(eeg_df["interview_age"], errors="coerce")
+    if ages.notna().equals(eeg_df["interview_age"].notna()) and (ages.dropna() % 1 == 0).all():
+        eeg_df["interview_age"] = ages.astype("Int64")  # months, written as 131 not 131.0
+
+    is_ambiguous = (
+        eeg_keys.merge(ambiguous_keys, on=MATCH_KEYS, how="left", indicator=True)["_merge"]
+        == "both"
+    ).to_numpy()
+    has_session = eeg_df["timepoint_label"].isin(redcap_dfs.keys()).to_numpy()
+    unmatched = eeg_df.index[has_session & ~is_matched.to_numpy() & ~is_ambiguous]
+    ambiguous = eeg_df.index[is_ambiguous]
+    return unmatched, ambiguous
+
 
 if __name__ == "__main__":
     eeg_file_path = sys.argv[1]
     ndar_submissions = sys.argv[2]
     if ndar_submissions:
         sessions = ndar_submissions.split(',')
+        with open(eeg_file_path, "r") as f:
+            structure_line = f.readline()  # "eeg_sub_files,01"
         eeg_df = pd.read_csv(eeg_file_path,header=1)
         redcap_dfs = dict()
         for sess in sessions:
@@ -21,15 +83,12 @@ if __name__ == "__main__":
                 redcap_dfs[ses] = pd.read_csv(redcap_file,header=1)
             else:
                 raise FileNotFoundError(f"File {redcap_file} does not exist.")
-        for index, row in eeg_df.iterrows():
-            timepoint_label = row['timepoint_label']
-            if timepoint_label in redcap_dfs:
-                redcap_df = redcap_dfs[timepoint_label]
-                print()
-                src_subject_id = row['src_subject_id']
-                matched_rows = redcap_df[redcap_df['src_subject_id'] == int(src_subject_id)]
-                if len(matched_rows) == 1:
-                    eeg_df.at[index, 'interview_date'] = matched_rows.iloc[0]['interview_date']
-                    eeg_df.at[index, 'interview_age'] = matched_rows.iloc[0]['interview_age']
-                    eeg_df.at[index, 'sex'] = matched_rows.iloc[0]['sex']
-        eeg_df.to_csv(eeg_file_path, index=False)
+        unmatched, ambiguous = backfill_demographics(eeg_df, redcap_dfs)
+        for label, rows in [("no match", unmatched), ("more than one match", ambiguous)]:
+            if len(rows) > 0:
+                print(f"{len(rows)} EEG row(s) with {label} in the NDAR CSVs, not filled:")
+                for _, row in eeg_df.loc[rows, MATCH_KEYS].iterrows():
+                    print(f"  {row['timepoint_label']} {row['src_subject_id']}")
+        with open(eeg_file_path, "w") as f:
+            f.write(structure_line)
+            eeg_df.to_csv(f, index=False)
@@ -0,0 +1,309 @@
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+### checks NDAR CSVs (from gen_NDAR_csvs.py or concat_csvs.py) against saved NDA data structure definitions,
+### so problems show up before upload: required fields, types, sizes, value ranges and date formats
+###
+### definitions are read from <definitions dir>, as saved from the NDA data dictionary for each structure:
+###   <short name>.json             (https://nda.nih.gov/api/datadictionary/datastructure/<short name>)
+###   <short name>_definitions.csv  ("Download Definitions" on the structure's page)
+###
+### USAGE: python3 validate_ndar_csvs.py <definitions dir> <csv or folder,csv or folder...> [report csv]
+
+MAX_PRINTED_VIOLATIONS = 20  # per file, when no report csv is given
+NDA_DATE_FORMAT = "%m/%d/%Y"  # what gen_NDAR_csvs.py writes
+INTEGER_RE = r"-?\d+"
+GUID_RE = r"NDAR(?:_INV)?[A-Z0-9]{8}"  # NDAR_INVXXXXXXXX, or NDARXXXXXXXX for older GUIDs
+
+
+def read_definition(definitions_dir, short_name):
+    """
+    Read a structure's saved NDA definition.
+
+    Returns:
+        list[dict]: One dict per data element with "name", "type", "size",
+            "required", "valueRange" and "aliases", or None if no definition
+            is saved for short_name.
+    """
+    json_file = os.path.join(definitions_dir, short_name + ".json")
+    csv_file = os.path.join(definitions_dir, short_name + "_definitions.csv")
+    if os.path.isfile(json_file):
+        with open(json_file, "r") as f:
+            structure = json.load(f)
+        return [
+            {
+                "name": element["name"],
+                "type": element.get("type") or "String",
+                "size": element.get("size"),
+                "required": element.get("required") or "",
+                "valueRange": element.get("valueRange") or "",
+                "aliases": element.get("aliases") or [],
+            }
+            for element in structure["dataElements"]
+        ]
+    if os.path.isfile(csv_file):
+        definition = pd.read_csv(csv_file, dtype=str, keep_default_na=False)
+        return [
+            {
+                "name": row["ElementName"],
+                "type": row["DataType"] or "String",
+                "size": row["Size"] or None,
+                "required": row["Required"],
+                "valueRange": row["ValueRange"],
+                "aliases": [
+                    alias.strip() for alias in row.get("Aliases", "").split(",") if alias.strip()
+                ],
+            }
+            for _, row in definition.iterrows()
+        ]
+    return None
+
+
+def parse_value_range(value_range):
+    """
+    Split an NDA valueRange like "0::4; -9; 999" into numeric ranges and codes.
+
+    Returns:
+        tuple[list[tuple[float, float]], list[str]]: (low, high) ranges and
+            the individual allowed codes.
+    """
+    ranges = []
+    codes = []
+    for token in value_range.split(";"):
+        token = token.strip()
+        if not token:
+            continue
+        if "::" in token:
+            low, high = token.split("::")
+            try:
+                ranges.append((float(low), float(high)))
+            except ValueError:
+                codes.append(token)
+        else:
+            codes.append(token)
+    return ranges, codes
+
+
+def compile_checks(element):
+    """
+    Compile a data element's definition into vectorized checks.
+
+    Each check takes the column as strings ("" for empty) and returns a boolean
+    mask of the rows that violate it. All checks but "required" only look at
+    non-empty values.
+
+    Returns:
+        list[tuple[str, Callable[[pd.Series], pd.Series]]]: (problem, check) pairs.
+    """
+    checks = []
+    data_type = element["type"].lower()
+
+    if element["required"].lower() == "required":
+        checks.append(("missing required value", lambda values: values == ""))
+
+    if data_type == "integer":
+        checks.append(
+            ("not an integer", lambda values: ~values.str.fullmatch(INTEGER_RE) & (values != ""))
+        )
+    elif data_type == "float":
+        checks.append(
+            (
+                "not a number",
+                lambda values: pd.to_numeric(values, errors="coerce").isna() & (values != ""),
+            )
+        )
+    elif data_type == "date":
+        checks.append(
+            (
+                "not a " + NDA_DATE_FORMAT + " date",
+                lambda values: pd.to_datetime(values, format=NDA_DATE_FORMAT, errors="coerce").isna()
+                & (values != ""),
+            )
+        )
+    elif data_type == "guid":
+        checks.append(
+            ("not an NDA GUID", lambda values: ~values.str.fullmatch(GUID_RE) & (values != ""))
+        )
+
+    if element["size"] and data_type in ["string", "guid"]:
+        size = int(float(element["size"]))
+        checks.append(
+            ("longer than " + str(size) + " characters", lambda values: values.str.len() > size)
+        )
+
+    ranges, codes = parse_value_range(element["valueRange"])
+    if ranges or codes:
+        if data_type in ["integer", "float"]:
+            code_numbers = pd.to_numeric(pd.Series(codes, dtype=object), errors="coerce").dropna()
+
+            def out_of_range(values):
+                numbers = pd.to_numeric(values, errors="coerce")
+                allowed = values.isin(codes) | numbers.isin(code_numbers)
+                for low, high in ranges:
+                    allowed |= numbers.between(low, high)
+                return ~allowed & numbers.notna()
+
+            checks.append(("outside " + element["valueRange"], out_of_range))
+        elif codes:
+            checks.append(
+                (
+                    "not one of " + element["valueRange"],
+                    lambda values: ~values.isin(codes) & (values != ""),
+                )
+            )
+    return checks
+
+
+def compile_structure(definition):
+    """
+    Compile every data element of a structure, keyed by name and by alias.
+    """
+    compiled = {}
+    for element in definition:
+        checks = compile_checks(element)
+        compiled[element["name"]] = (element, checks)
+        for alias in element["aliases"]:
+            compiled.setdefault(alias, (element, checks))
+    return compiled
+
+
+def read_short_name(ndar_file):
+    """
+    Structure short name from an NDAR CSV's first line ("pds,01" -> "pds01").
+    """
+    with open(ndar_file, "r") as f:
+        first_line = f.readline().strip().split(",")
+    return first_line[0] + (first_line[1] if len(first_line) > 1 else "")
+
+
+def read_ndar_csv(ndar_file):
+    """
+    Read an NDAR CSV as strings, returning (structure short name, data).
+    """
+    ndar_df = pd.read_csv(ndar_file, skiprows=1, dtype=str, keep_default_na=False)
+    return read_short_name(ndar_file), ndar_df
+
+
+def validate_csv(ndar_file, compiled):
+    """
+    Run a structure's compiled checks over every column of an NDAR CSV.
+
+    Returns:
+        pd.DataFrame: One row per violation with "file", "row" (line in the
+            file), "field", "value" and "problem", sorted by row and field.
+    """
+    short_name, ndar_df = read_ndar_csv(ndar_file)
+    # data rows start on the third line, after "<structure>,01" and the header
+    line_numbers = np.arange(len(ndar_df)) + 3
+    violations = []
+
+    columns = set(ndar_df.columns)
+    for name, (element, _) in compiled.items():
+        if name != element["name"]:
+            continue  # alias
+        present = name in columns or any(alias in columns for alias in element["aliases"])
+        if element["required"].lower() == "required" and not present:
+            violations.append(
+                pd.DataFrame(
+                    {"row": [2], "field": [name], "value": [""], "problem": ["required column missing"]}
+                )
+            )
+
+    for col in ndar_df.columns:
+        if col not in compiled.keys():
+            violations.append(
+                pd.DataFrame(
+                    {"row": [2], "field": [col], "value": [""], "problem": ["not in " + short_name]}
+                )
+            )
+            continue
+        values = ndar_df[col]
+        for problem, check in compiled[col][1]:
+            bad_rows = np.flatnonzero(check(values).to_numpy(dtype=bool))
+            if len(bad_rows) == 0:
+                continue
+            violations.append(
+                pd.DataFrame(
+                    {
+                        "row": line_numbers[bad_rows],
+                        "field": col,
+                        "value": values.to_numpy()[bad_rows],
+                        "problem": problem,
+                    }
+                )
+            )
+
+    if not violations:
+        return pd.DataFrame(columns=["file", "row", "field", "value", "problem"])
+    violations = pd.concat(violations, ignore_index=True)
+    violations.insert(0, "file", ndar_file)
+    return violations.sort_values(["row", "field"], kind="stable", ignore_index=True)
+
+
+def get_ndar_files(paths):
+    """
+    Expand folders into the NDAR CSVs they contain.
+    """
+    ndar_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            ndar_files.extend(
+                os.path.join(path, file)
+                for file in sorted(os.listdir(path))
+                if file.endswith(".csv")
+            )
+        else:
+            ndar_files.append(path)
+    return ndar_files
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [3, 4]:
+        print(
+            "python3 validate_ndar_csvs.py <definitions dir> "
+            "<csv or folder,csv or folder...> [report csv]"
+        )
+        exit()
+
+    definitions_dir = sys.argv[1]
+    ndar_files = get_ndar_files(sys.argv[2].split(","))
+    report_file = sys.argv[3] if len(sys.argv) == 4 else None
+
+    structures = {}  # short name -> compiled checks
+    reports = []
+    for ndar_file in ndar_files:
+        start = time.perf_counter()
+        short_name = read_short_name(ndar_file)
+        if short_name not in structures.keys():
+            definition = read_definition(definitions_dir, short_name)
+            structures[short_name] = None if definition is None else compile_structure(definition)
+        if structures[short_name] is None:
+            print(f"Warning: no definition saved for {short_name}, skipping {ndar_file}")
+            continue
+
+        violations = validate_csv(ndar_file, structures[short_name])
+        reports.append(violations)
+        print(
+            f"{ndar_file}: {len(violations)} violation(s) "
+            f"({time.perf_counter() - start:.2f}s)"
+        )
+        if report_file is None:
+            for _, violation in violations.head(MAX_PRINTED_VIOLATIONS).iterrows():
+                print(
+                    f"  row {violation['row']}, {violation['field']}: "
+                    f"{violation['problem']} ({violation['value']!r})"
+                )
+            if len(violations) > MAX_PRINTED_VIOLATIONS:
+                print(f"  ... and {len(violations) - MAX_PRINTED_VIOLATIONS} more")
+
+    num_violations = sum(len(violations) for violations in reports)
+    if report_file is not None and reports:
+        pd.concat(reports, ignore_index=True).to_csv(report_file, index=False)
+        print(f"wrote {num_violations} violation(s) to {report_file}")
+    if num_violations > 0:
+        sys.exit(1)
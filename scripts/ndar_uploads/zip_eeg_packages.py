@@ -0,0 +1,123 @@
+import csv
+import hashlib
+import os
+from os.path import basename, join, isdir, isfile
+import sys
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+### zips every EEG package staged by new_ndar_submission.py (<submission>/eeg/<package>/) into
+### <submission>/eeg/<package>.zip, several packages at a time
+###
+### each finished archive's size and SHA-256 go in <submission>/eeg_packages.csv; on a retry, packages
+### whose archive is already listed there with the same size are skipped
+###
+### USAGE: python3 zip_eeg_packages.py <dataset> <current submission> [number of workers]
+
+MANIFEST_FILE = "eeg_packages.csv"
+MANIFEST_COLUMNS = ["package", "bytes", "sha256"]
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def read_manifest(manifest_file):
+    """
+    Read the archives already built, as package -> {"bytes", "sha256"}.
+    """
+    if not isfile(manifest_file):
+        return {}
+    with open(manifest_file, "r", newline="") as f:
+        return {row["package"]: row for row in csv.DictReader(f)}
+
+
+def build_archive(staged_dir, zip_file):
+    """
+    Zip a staged package folder, keeping its folder name at the top of the archive.
+
+    Files are streamed into the archive in chunks by zipfile, so multi-GB .eeg
+    files are never held in memory. The archive is written to a temp file and
+    renamed into place once complete.
+
+    Returns:
+        tuple[str, int, str]: Package name, archive size and SHA-256.
+    """
+    tmp_file = zip_file + ".tmp"
+    parent_dir = os.path.dirname(staged_dir)
+    try:
+        with zipfile.ZipFile(tmp_file, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+            for root, dirs, files in os.walk(staged_dir):
+                dirs.sort()
+                zf.write(root, arcname=os.path.relpath(root, parent_dir))
+                for file in sorted(files):
+                    path = join(root, file)
+                    zf.write(path, arcname=os.path.relpath(path, parent_dir))
+        size = os.path.getsize(tmp_file)
+        sha256 = file_sha256(tmp_file)
+        os.replace(tmp_file, zip_file)
+    except BaseException:
+        if os.path.exists(tmp_file):
+            os.remove(tmp_file)
+        raise
+    return basename(zip_file), size, sha256
+
+
+def get_num_workers():
+    """CPUs this job may use (SLURM_CPUS_PER_TASK, else the CPU affinity)."""
+    if os.environ.get("SLURM_CPUS_PER_TASK"):
+        return int(os.environ["SLURM_CPUS_PER_TASK"])
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS
+        return os.cpu_count() or 1
+
+
+if __name__ == "__main__":
+    if len(sys.argv) not in [3, 4]:
+        print("python3 zip_eeg_packages.py <dataset> <current submission> [number of workers]")
+        exit()
+    dataset = '/home/data/NDClab/datasets/' + sys.argv[1]
+    current_submission = sys.argv[2]
+    num_workers = int(sys.argv[3]) if len(sys.argv) == 4 else get_num_workers()
+    submission_dir = join(dataset, 'data-monitoring', 'ndar', current_submission)
+    eeg_dir = join(submission_dir, 'eeg')
+    if not isdir(eeg_dir):
+        sys.exit("Error, " + eeg_dir + " doesn't exist, run new_ndar_submission.py first")
+
+    manifest_file = join(submission_dir, MANIFEST_FILE)
+    manifest = read_manifest(manifest_file)
+    to_build = []
+    for package_dir in sorted(os.listdir(eeg_dir)):
+        if not isdir(join(eeg_dir, package_dir)) or package_dir.endswith(".tmp"):
+            continue  # zips, and folders still being staged
+        zip_file = join(eeg_dir, package_dir + ".zip")
+        built = manifest.get(basename(zip_file))
+        if built and isfile(zip_file) and os.path.getsize(zip_file) == int(built["bytes"]):
+            continue
+        to_build.append((join(eeg_dir, package_dir), zip_file))
+    print(f"{len(to_build)} package(s) to zip, {len(manifest)} already in {MANIFEST_FILE}")
+
+    new_manifest = not isfile(manifest_file)
+    with open(manifest_file, "a", newline="") as f, ProcessPoolExecutor(
+        max_workers=num_workers
+    ) as executor:
+        writer = csv.writer(f)
+        if new_manifest:
+            writer.writerow(MANIFEST_COLUMNS)
+        futures = [
+            executor.submit(build_archive, staged_dir, zip_file)
+            for staged_dir, zip_file in to_build
+        ]
+        for future in as_completed(futures):
+            package, size, sha256 = future.result()
+            writer.writerow([package, size, sha256])
+            f.flush()  # so a retry after a crash skips what's done
+            print(f"zipped {package} ({size} bytes)")
+
+    print("Zipping of folders complete, see " + eeg_dir + " for outputs.")
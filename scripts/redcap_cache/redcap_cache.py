@@ -0,0 +1,241 @@
+"""
+Persistent cache of parsed REDCap exports.
+
+REDCap exports are wide CSVs (thousands of columns) that several of our
+scripts parse many times a day. The first time an export is read it's parsed
+with pandas as usual and saved as an uncompressed Arrow IPC file; every later
+read of the same file is served by memory-mapping that Arrow file instead of
+re-parsing the CSV. The columns that are read are still copied into a pandas
+DataFrame, so reading fewer columns (usecols) is what saves memory.
+
+A read with usecols only parses and caches those columns; a later read that
+needs more columns re-parses the export for the union of the two.
+
+Entries are keyed by (path, size, mtime, SHA-256 of the content), so a REDCap
+that is copied or touched without changing is still a cache hit, and the cache
+is trimmed to REDCAP_CACHE_MAX_BYTES by evicting the least recently used
+entries.
+
+If pyarrow isn't installed, reads fall back to pd.read_csv.
+
+USAGE:
+    sys.path.append("/home/data/NDClab/tools/lab-devOps/scripts/redcap_cache")
+    from redcap_cache import read_redcap
+    rc_df = read_redcap(redcap_path, index_col="record_id")
+"""
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    from pyarrow import ipc
+except ImportError:
+    pa = None
+
+CACHE_DIR = os.environ.get(
+    "REDCAP_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "ndclab", "redcap")
+)
+MAX_CACHE_BYTES = int(os.environ.get("REDCAP_CACHE_MAX_BYTES", 5 * 1024**3))
+HASH_BLOCK_SIZE = 1024 * 1024
+INDEX_FILE = "index.json"
+LOCK_FILE = "index.lock"
+PARTIAL_KEY = b"redcap_cache_partial"  # schema metadata of entries holding only some columns
+
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+class RedcapCache:
+    """
+    An on-disk cache of parsed REDCap exports, stored as Arrow IPC files.
+
+    The index (index.json) has two parts:
+        "paths":   abspath -> {"size", "mtime_ns", "sha256"} of the last file
+                   seen at that path, so unchanged files aren't re-hashed.
+        "entries": sha256 -> {"file", "nbytes", "last_used"} for each cached
+                   export, used for the size-bounded LRU eviction.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_bytes=MAX_CACHE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.tables = {}  # sha256 -> memory-mapped pa.Table, for this process
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+
+    def read(self, path, index_col=None, usecols=None):
+        """
+        Read a REDCap export, like pd.read_csv(path, index_col=..., usecols=...).
+
+        Args:
+            path (str): Path to the REDCap CSV.
+            index_col (str, optional): Column to use as the index.
+            usecols (list[str], optional): Only return these columns (the index
+                column is always included).
+
+        Returns:
+            pd.DataFrame: The parsed REDCap.
+        """
+        if pa is None:
+            return pd.read_csv(path, index_col=index_col, usecols=usecols)
+
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        index = self.load_index()
+        seen = index["paths"].get(path)
+        if seen and seen["size"] == st.st_size and seen["mtime_ns"] == st.st_mtime_ns:
+            sha256 = seen["sha256"]
+        else:
+            sha256 = file_sha256(path)
+
+        cols = None
+        if usecols is not None:
+            cols = list(usecols)
+            if index_col is not None and index_col not in cols:
+                cols.insert(0, index_col)
+
+        table = self.tables.get(sha256)
+        if table is None:
+            table = self.load_table(sha256)
+        if table is None or not self.has_columns(table, cols):
+            store_cols = None
+            if cols is not None:
+                # parse only what's asked for, plus what earlier reads cached
+                cached = table.column_names if table is not None else []
+                store_cols = cached + [col for col in cols if col not in cached]
+            table = self.store_table(path, sha256, store_cols)
+            if table is None:  # couldn't be converted to Arrow, don't cache
+                return pd.read_csv(path, index_col=index_col, usecols=usecols)
+        self.tables[sha256] = table
+        self.touch(path, st, sha256)
+
+        if cols is not None:
+            missing = [col for col in cols if col not in table.column_names]
+            if missing:
+                raise ValueError(
+                    f"Usecols do not match columns, columns expected but not found: {missing}"
+                )
+            table = table.select(cols)
+        df = table.to_pandas(split_blocks=True)
+        if index_col is not None:
+            df = df.set_index(index_col)
+        return df
+
+    def data_file(self, sha256):
+        return os.path.join(self.cache_dir, sha256 + ".arrow")
+
+    @staticmethod
+    def has_columns(table, cols):
+        """Whether a cached table can serve a read of cols (None for all columns)."""
+        if table.schema.metadata is None or PARTIAL_KEY not in table.schema.metadata:
+            return True  # every column of the export is cached
+        return cols is not None and all(col in table.column_names for col in cols)
+
+    def load_table(self, sha256):
+        """Memory-map a cached export, or return None if it isn't cached."""
+        try:
+            source = pa.memory_map(self.data_file(sha256), "r")
+        except FileNotFoundError:
+            return None
+        return ipc.open_file(source).read_all()
+
+    def store_table(self, path, sha256, usecols=None):
+        """
+        Parse a REDCap CSV and add it to the cache, returning the mapped table.
+
+        With usecols, only those columns are parsed and the entry is marked
+        partial, replacing any earlier entry for the same content.
+        """
+        df = pd.read_csv(path, usecols=usecols)
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+        except (pa.ArrowInvalid, pa.ArrowTypeError):
+            return None  # e.g. a column mixing numbers and strings
+        del df
+        if usecols is not None:
+            table = table.replace_schema_metadata({**(table.schema.metadata or {}), PARTIAL_KEY: b"1"})
+        fd, tmp_file = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                with ipc.new_file(f, table.schema) as writer:
+                    writer.write_table(table)
+            os.replace(tmp_file, self.data_file(sha256))
+        except BaseException:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
+            raise
+        return self.load_table(sha256)
+
+    def load_index(self):
+        try:
+            with open(os.path.join(self.cache_dir, INDEX_FILE), "r") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {"paths": {}, "entries": {}}
+
+    def save_index(self, index):
+        fd, tmp_file = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_file, os.path.join(self.cache_dir, INDEX_FILE))
+
+    def touch(self, path, st, sha256):
+        """Record a use of an entry, then evict entries past max_bytes."""
+        with open(os.path.join(self.cache_dir, LOCK_FILE), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            index = self.load_index()
+            index["paths"][path] = {
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+                "sha256": sha256,
+            }
+            index["entries"][sha256] = {
+                "file": os.path.basename(self.data_file(sha256)),
+                "nbytes": os.path.getsize(self.data_file(sha256)),
+                "last_used": time.time(),
+            }
+            self.evict(index, keep=sha256)
+            self.save_index(index)
+
+    def evict(self, index, keep=None):
+        """Drop least recently used entries until the cache fits in max_bytes."""
+        entries = index["entries"]
+        total = sum(entry["nbytes"] for entry in entries.values())
+        for sha256 in sorted(entries, key=lambda sha: entries[sha]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if sha256 == keep:
+                continue
+            total -= entries[sha256]["nbytes"]
+            del entries[sha256]
+            self.tables.pop(sha256, None)
+            try:
+                os.remove(self.data_file(sha256))
+            except FileNotFoundError:
+                pass
+        index["paths"] = {
+            path: seen for path, seen in index["paths"].items() if seen["sha256"] in entries
+        }
+
+
+_cache = None
+
+
+def read_redcap(path, index_col=None, usecols=None):
+    """
+    Read a REDCap export through the shared cache (see RedcapCache.read).
+    """
+    global _cache
+    if _cache is None:
+        _cache = RedcapCache()
+    return _cache.read(path, index_col=index_col, usecols=usecols)